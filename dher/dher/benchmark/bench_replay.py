@@ -0,0 +1,279 @@
+"""Headless micro-benchmarks of the DHER replay buffers and samplers on synthetic episodes.
+
+    python -m dher.benchmark.bench_replay --out bench.json
+
+Every case runs in a fresh interpreter and reports the number of operations per second and the
+peak resident set size of its process; the JSON output can be diffed between commits.
+"""
+import copy
+import functools
+import itertools
+import json
+import platform
+import resource
+import subprocess
+import sys
+import threading
+import time
+
+import click
+import numpy as np
+from gym import spaces
+
+from dher.ddpg_dher import dher_replay_buffer as ddpg_replay_buffer
+from dher.ddpg_dher import dher_sample as ddpg_sample
+from dher.dqn_dher import dher_replay_buffer as dqn_replay_buffer
+
+
+# shapes of DyReachEnv-v0 and DySnake-v0 as registered by the experiments
+DYREACH = {'T': 50, 'o': 10, 'g': 3, 'u': 4, 'velocity': 0.011, 'target_range': 0.1,
+           'distance_threshold': 0.01}
+DYSNAKE = {'T': 50, 'state_size': 20, 'n_actions': 5, 'reward_dir': 2}
+
+
+def dyreach_episodes(n, spec=DYREACH):
+    """Synthetic DyReach episode batch: the desired goal moves along a random direction at the
+    env's velocity and the achieved goal random walks inside the target range, so that achieved
+    and desired goals of different episodes cross like in the real env.
+    """
+    T, r = spec['T'], spec['target_range']
+    direction = np.random.randn(n, 1, spec['g'])
+    direction /= np.linalg.norm(direction, axis=-1, keepdims=True)
+    g = np.random.uniform(-r, r, (n, 1, spec['g'])) + direction * spec['velocity'] * np.arange(T + 1)[:, None]
+    ag = np.random.uniform(-r, r, (n, 1, spec['g'])) + np.cumsum(
+        np.random.uniform(-0.01, 0.01, (n, T + 1, spec['g'])), axis=1)
+    ag = np.clip(ag, -r, r)
+    o = np.concatenate([ag, np.random.randn(n, T + 1, spec['o'] - spec['g'])], axis=-1)
+    success = np.linalg.norm(ag[:, 1:] - g[:, 1:], axis=-1, keepdims=True) < spec['distance_threshold']
+    return {
+        'o': o.astype(np.float32),
+        'u': np.random.uniform(-1., 1., (n, T, spec['u'])).astype(np.float32),
+        'g': g.astype(np.float32),
+        'ag': ag.astype(np.float32),
+        'info_is_success': success.astype(np.float32),
+    }
+
+
+def dysnake_transitions(n, spec=DYSNAKE):
+    """Synthetic DySnake transitions (obs_t, action, reward, obs_tp1, done) of consecutive
+    episodes: the snake takes random actions clamped to the board and the goal moves in the
+    fixed direction `reward_dir`, wrapping around the board. Endless if `n` is None.
+    """
+    size, T = spec['state_size'], spec['T']
+    steps = {0: (0, 0), 1: (0, -1), 2: (0, 1), 3: (-1, 0), 4: (1, 0)}
+    snake, goal, t = None, None, T
+    for _ in (range(n) if n is not None else itertools.count()):
+        if t == T:
+            snake = np.random.randint(size, size=2)
+            goal = np.random.randint(size, size=2)
+            t = 0
+        obs = np.concatenate([snake, goal, snake - goal])
+        action = np.random.randint(spec['n_actions'])
+        snake = np.clip(snake + steps[action], 0, size - 1)
+        reached = (snake == goal).all()
+        if not reached:
+            goal = (goal + steps[spec['reward_dir']]) % size
+            reached = (snake == goal).all()
+        t += 1
+        done = reached or t == T
+        if reached:
+            t = T
+        yield obs, action, 0. if reached else -1., np.concatenate([snake, goal, snake - goal]), float(done)
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    scale = 2. ** 20 if sys.platform == 'darwin' else 2. ** 10
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+
+def measure(fn, min_time, setup=None, calls_per_setup=None, make_args=None):
+    """Calls `fn` until `min_time` seconds have passed and returns the calls and seconds. If
+    `setup` is given, it is called untimed before the first call and then after every
+    `calls_per_setup` calls. If `make_args` is given, it is called untimed before every call and
+    its result is passed to `fn`.
+    """
+    n, elapsed = 0, 0.
+    while True:
+        if setup is not None and (n == 0 or (calls_per_setup is not None and n % calls_per_setup == 0)):
+            setup()
+        args = make_args() if make_args is not None else ()
+        start = time.perf_counter()
+        fn(*args)
+        elapsed += time.perf_counter() - start
+        n += 1
+        if elapsed >= min_time:
+            return n, elapsed
+
+
+def copy_ddpg_buffer(buffer):
+    """Deep copy of a DDPG replay buffer. The lock is not copied and the views of the next
+    observations and goals are recreated on the copied episodes.
+    """
+    lock, buffer.lock = buffer.lock, None
+    try:
+        clone = copy.deepcopy(buffer)
+    finally:
+        buffer.lock = lock
+    clone.lock = threading.Lock()
+    clone.buffers['o_2'] = clone.buffers['o'][:, 1:, :]
+    clone.buffers['ag_2'] = clone.buffers['ag'][:, 1:, :]
+    clone.buffers['dg_2'] = clone.buffers['g'][:, 1:, :]
+    return clone
+
+
+def stores_per_copy(capacity, stored, per_store, max_growth=0.01):
+    """The number of stores after which a buffer that is not full has grown by `max_growth` of
+    its capacity and is replaced by a fresh copy of the pre-filled one; None if it is full.
+    """
+    if stored >= capacity:
+        return None
+    return max(int(max_growth * capacity) // per_store, 1)
+
+
+def bench_ddpg(name, buffer_size, fill, min_time, rollout_batch_size=2, batch_size=256, spec=DYREACH):
+    T = spec['T']
+    shapes = {'o': (T + 1, spec['o']), 'u': (T, spec['u']), 'g': (T + 1, spec['g']),
+              'ag': (T + 1, spec['g']), 'info_is_success': (T, 1)}
+    reward_fun = ddpg_sample.GoalDistanceReward(spec['distance_threshold'])
+    sample_transitions = ddpg_sample.make_sample_her_transitions('future', 4, reward_fun)
+    buffer = ddpg_replay_buffer.ReplayBuffer(shapes, buffer_size, T, sample_transitions)
+
+    # fill levels of 1 and above keep the buffer full, so that every store evicts episodes
+    n_fill = max(int(round(fill * buffer.size)), rollout_batch_size)
+    for start in range(0, n_fill, 100):
+        buffer.store_episode(dyreach_episodes(min(100, n_fill - start)))
+
+    # a buffer that is not full is stored into through a copy of the pre-filled buffer, that is
+    # replaced before it has grown by more than 1% of its size; the copy adds to the peak
+    # resident set size of the case
+    current, calls_per_setup, make_args = [buffer], None, None
+
+    def setup():
+        current[0] = None
+        current[0] = copy_ddpg_buffer(buffer)
+
+    if name == 'ddpg/store_episode':
+        # every store gets fresh episodes, so that the evicted ones are not replaced by duplicates
+        # and the intersection table keeps the size of the pre-filled buffer
+        make_args = lambda: (dyreach_episodes(rollout_batch_size),)
+        calls_per_setup = stores_per_copy(buffer.size, buffer.current_size, rollout_batch_size)
+        fn = lambda episode_batch: current[0].store_episode(episode_batch)
+    elif name == 'ddpg/sample':
+        fn = lambda: buffer.sample(batch_size)
+    elif name == 'ddpg/sample_transitions':
+        # plain HER sampling, without the intersections of DHER
+        fn = lambda: sample_transitions(buffer.buffers, batch_size, n_episodes=buffer.current_size)
+    else:
+        raise ValueError('Unknown case {}.'.format(name))
+    n, elapsed = measure(fn, min_time, setup if calls_per_setup is not None else None, calls_per_setup, make_args)
+    return {'name': name, 'buffer_size': buffer_size, 'fill': fill, 'ops': n,
+            'seconds': elapsed, 'ops_per_s': n / elapsed,
+            'n_intersections': int(current[0].n_inter), 'peak_rss_mb': peak_rss_mb()}
+
+
+def bench_dqn(name, buffer_size, fill, min_time, batch_size=32, spec=DYSNAKE):
+    size = spec['state_size']
+    observation_space = spaces.Box(low=-size, high=size, shape=(6,), dtype=np.float32)
+    buffer = dqn_replay_buffer.ReplayBuffer(buffer_size, observation_space, spaces.Discrete(spec['n_actions']))
+
+    n_fill = max(int(round(fill * buffer_size)), batch_size)
+    transitions = dysnake_transitions(n_fill)
+    for transition in transitions:
+        buffer.add(*transition)
+
+    # fresh transitions are added to a copy of the pre-filled buffer, see bench_ddpg
+    current, calls_per_setup, make_args = [buffer], None, None
+
+    def setup():
+        current[0] = None
+        current[0] = copy.deepcopy(buffer)
+
+    if name == 'dqn/add':
+        make_args = functools.partial(next, dysnake_transitions(None))
+        calls_per_setup = stores_per_copy(buffer_size, len(buffer), 1)
+        fn = lambda *transition: current[0].add(*transition)
+    elif name == 'dqn/sample':
+        fn = lambda: buffer.sample(batch_size)
+    else:
+        raise ValueError('Unknown case {}.'.format(name))
+    n, elapsed = measure(fn, min_time, setup if calls_per_setup is not None else None, calls_per_setup, make_args)
+    return {'name': name, 'buffer_size': buffer_size, 'fill': fill, 'ops': n,
+            'seconds': elapsed, 'ops_per_s': n / elapsed,
+            'n_intersections': len(current[0]._intersection), 'peak_rss_mb': peak_rss_mb()}
+
+
+DDPG_CASES = ['ddpg/sample', 'ddpg/sample_transitions', 'ddpg/store_episode']
+DQN_CASES = ['dqn/sample', 'dqn/add']
+
+
+def run_case(case, min_time, seed):
+    """Runs a single case in this process."""
+    np.random.seed(seed)
+    bench = bench_ddpg if case['name'] in DDPG_CASES else bench_dqn
+    return bench(case['name'], case['buffer_size'], case['fill'], min_time)
+
+
+def run_case_subprocess(case, min_time, seed):
+    """Runs a single case in a fresh interpreter, so that its peak resident set size is not
+    inflated by the cases before it.
+    """
+    output = subprocess.check_output([sys.executable, '-m', 'dher.benchmark.bench_replay',
+                                      '--case', json.dumps(case), '--min_time', str(min_time),
+                                      '--seed', str(seed)])
+    return json.loads(output.decode())
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(ddpg_sizes, dqn_sizes, fills, min_time, seed):
+    """Runs every benchmark case and returns the results together with the environment."""
+    cases = [{'name': name, 'buffer_size': buffer_size, 'fill': fill}
+             for sizes, names in ((ddpg_sizes, DDPG_CASES), (dqn_sizes, DQN_CASES))
+             for buffer_size in sizes for fill in fills for name in names]
+    results = [run_case_subprocess(case, min_time, seed) for case in cases]
+    meta = {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'seed': seed,
+        'min_time': min_time,
+    }
+    return {'meta': meta, 'results': results}
+
+
+@click.command()
+@click.option('--out', type=str, default=None, help='the path of the JSON results. If not specified, they are printed.')
+@click.option('--ddpg_sizes', type=str, default='100000,1000000', help='comma separated DDPG replay buffer sizes in transitions')
+@click.option('--dqn_sizes', type=str, default='50000,500000', help='comma separated DQN replay buffer sizes in transitions')
+@click.option('--fills', type=str, default='0.1,0.5,1.0', help='comma separated fill levels of the buffers; 1.0 means full, so that stores evict')
+@click.option('--min_time', type=float, default=1.0, help='the number of seconds each case is run for')
+@click.option('--seed', type=int, default=0, help='the random seed of the synthetic episodes')
+@click.option('--case', type=str, default=None, hidden=True, help='JSON of a single case to run in this process')
+def main(out, ddpg_sizes, dqn_sizes, fills, min_time, seed, case):
+    def parse(values, cast):
+        return [cast(float(value)) for value in values.split(',') if value]
+
+    if case is not None:
+        print(json.dumps(run_case(json.loads(case), min_time, seed)))
+        return
+
+    report = run(parse(ddpg_sizes, int), parse(dqn_sizes, int), parse(fills, float), min_time, seed)
+    for result in report['results']:
+        print('{name:<24} size={buffer_size:<8} fill={fill:<4} {ops_per_s:>12.1f} ops/s '
+              'peak_rss={peak_rss_mb:.1f}MB'.format(**result), file=sys.stderr)
+    if out is None:
+        print(json.dumps(report, indent=2))
+    else:
+        with open(out, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
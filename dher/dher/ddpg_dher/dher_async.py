@@ -0,0 +1,120 @@
+import threading
+import time
+from queue import Queue, Empty, Full
+
+from dher.ddpg_dher.dher_policy import NumpyPolicy, policy_params
+
+
+class PolicySnapshot(NumpyPolicy):
+    def __init__(self, policy):
+        """NumPy copy of the main actor and the normalizer statistics of a DDPG policy, so that
+        actions can be computed without going through the TensorFlow session.
+
+        Args:
+            policy (DDPG): the policy that is copied; `refresh` copies its current parameters
+        """
+        self.policy = policy
+        self.refresh()
+
+    def refresh(self):
+        """Copies the current parameters of the policy.
+        """
+        self.set_params(policy_params(self.policy, include_Q=False))
+
+
+class AsyncRolloutWorker:
+    def __init__(self, rollout_worker, policy, snapshot_interval=40, queue_size=2):
+        """Generates rollouts in a background thread while the learner trains. The rollout worker
+        acts with a PolicySnapshot of `policy` that the learner refreshes every `snapshot_interval`
+        updates, and the episodes are handed over through a bounded queue. Environment stepping
+        can additionally be moved to subprocesses with the 'subproc' vec env.
+
+        Args:
+            rollout_worker (RolloutWorker): the worker that generates the episodes; its policy is
+                replaced by the snapshot
+            policy (DDPG): the policy that is trained
+            snapshot_interval (int): number of updates after which the snapshot is refreshed
+            queue_size (int): maximum number of episode batches waiting for the learner
+        """
+        self.rollout_worker = rollout_worker
+        self.snapshot = PolicySnapshot(policy)
+        self.rollout_worker.policy = self.snapshot
+        self.snapshot_interval = snapshot_interval
+        self.queue = Queue(maxsize=queue_size)
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.error = None
+
+        self.n_env_steps = 0
+        self.n_updates = 0
+        self.updates_since_refresh = 0
+        self.last_time = time.time()
+        self.last_env_steps = 0
+        self.last_updates = 0
+
+    def _run(self):
+        try:
+            while not self.stop_event.is_set():
+                episode = self.rollout_worker.generate_rollouts()
+                # the rollout worker overwrites its episode arrays on the next call
+                episode = {key: value.copy() for key, value in episode.items()}
+                self.n_env_steps += episode['u'].shape[0] * episode['u'].shape[1]
+                while not self.stop_event.is_set():
+                    if self._put(episode):
+                        break
+        except Exception as e:
+            self.error = e
+
+    def _put(self, episode, timeout=0.1):
+        try:
+            self.queue.put(episode, timeout=timeout)
+        except Full:
+            return False
+        return True
+
+    def start(self):
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def get_episode(self):
+        """Blocks until the next episode batch is available and returns it.
+        """
+        while True:
+            if self.error is not None:
+                raise self.error
+            try:
+                return self.queue.get(timeout=1.)
+            except Empty:
+                if self.thread is None or not self.thread.is_alive():
+                    raise RuntimeError('the rollout thread is not running')
+
+    def record_updates(self, n=1):
+        """Counts `n` learner updates and refreshes the snapshot every `snapshot_interval` updates.
+        """
+        self.n_updates += n
+        self.updates_since_refresh += n
+        if self.updates_since_refresh >= self.snapshot_interval:
+            self.snapshot.refresh()
+            self.updates_since_refresh = 0
+
+    def logs(self, prefix='async'):
+        """Environment steps and learner updates per second since the previous call.
+        """
+        now = time.time()
+        elapsed = max(now - self.last_time, 1e-8)
+        logs = []
+        logs += [('env_steps_per_s', (self.n_env_steps - self.last_env_steps) / elapsed)]
+        logs += [('updates_per_s', (self.n_updates - self.last_updates) / elapsed)]
+        self.last_time, self.last_env_steps, self.last_updates = now, self.n_env_steps, self.n_updates
+
+        if prefix != '' and not prefix.endswith('/'):
+            return [(prefix + '/' + key, val) for key, val in logs]
+        else:
+            return logs
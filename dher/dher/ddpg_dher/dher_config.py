@@ -1,5 +1,9 @@
+import json
+import os
+
 import numpy as np
 import gym
+from mpi4py import MPI
 
 from baselines import logger
 
@@ -24,6 +28,7 @@ DEFAULT_PARAMS = {
     'Q_lr': 0.001,  # critic learning rate
     'pi_lr': 0.001,  # actor learning rate
     'buffer_size': int(1E6),  # for experience replay
+    'buffer_dtype': 'float32',  # dtype the replay buffer stores transitions in
     'polyak': 0.95,  # polyak averaging coefficient
     'action_l2': 1.0,  # quadratic penalty on actions (before rescaling by max_u)
     'clip_obs': 200.,
@@ -32,19 +37,32 @@ DEFAULT_PARAMS = {
     # training
     'n_cycles': 50,  # per epoch
     'rollout_batch_size': 2,  # per mpi thread
+    'vec_env': 'serial',  # how rollout environments are stepped: serial (in process) or subproc
+    'rollout_max_retries': 10,  # faulty env steps tolerated per rollout batch before giving up
+    'async_rollouts': False,  # generate rollouts in a background thread while the learner trains
+    'snapshot_interval': 40,  # learner updates between refreshes of the policy snapshot the async rollouts act with
+    'async_queue_size': 2,  # episode batches the async rollouts may run ahead of the learner
     'n_batches': 40,  # training batches per cycle
     'batch_size': 256,  # per mpi thread, measured in transitions and reduced to even multiple of chunk_length.
+    'prefetch_batches': 2,  # batches sampled and staged ahead of training by a background thread, 0 disables it
+    'fused_train': False,  # one session run per update with in-graph Adam, only with a single MPI worker
+    'fused_steps': 1,  # updates per session run with fused_train, has to divide n_batches
     'n_test_rollouts': 10,  # number of test rollouts per epoch, each consists of rollout_batch_size rollouts
     'test_with_polyak': False,  # run test episodes with the target network
+    'test_batched': True,  # run all test rollouts of an epoch as one batch of n_test_rollouts * rollout_batch_size envs
+    'test_freeze_done': False,  # stop stepping test envs once they succeeded, ending the rollout early when all did
+    'timing': True,  # record per-phase wall-clock timings and log them every epoch
     # exploration
     'random_eps': 0.3,  # percentage of time a random action is taken
     'noise_eps': 0.2,  # std of gaussian noise added to not-completely-random actions as a percentage of max_u
     # HER
     'replay_strategy': 'future',  # supported modes: future, none
     'replay_k': 4,  # number of additional goals used for replay, only used if off_policy_data=future
+    'goal_resolution': 0.01,  # grid spacing used to match achieved and desired goals in DHER
     # normalization
     'norm_eps': 0.01,  # epsilon used for observation normalization
     'norm_clip': 5,  # normalized observations are cropped to this values
+    'norm_update_interval': 1,  # store_episode calls between recomputations of the normalizer statistics
 }
 
 
@@ -63,7 +81,72 @@ def cached_make_env(make_env):
     return CACHED_ENVS[make_env]
 
 
-def prepare_params(kwargs):
+ENV_SPECS = {}
+ENV_SPEC_FIELDS = ['T', 'dims', 'distance_threshold', 'reward_type']
+
+
+def env_spec_key(env_name):
+    """Identifies an environment by its id and the kwargs it is registered with."""
+    spec = gym.spec(env_name)
+    env_kwargs = getattr(spec, '_kwargs', None) or getattr(spec, 'kwargs', None) or {}
+    return '{}:{}'.format(env_name, json.dumps(env_kwargs, sort_keys=True, default=str))
+
+
+def probe_env_spec(make_env):
+    """Creates the environment once to read off its horizon and the dimensions of observations,
+    goals, actions and infos.
+    """
+    env = make_env()
+    assert hasattr(env, '_max_episode_steps')
+    env.reset()
+    obs, _, _, info = env.step(env.action_space.sample())
+
+    dims = {
+        'o': obs['observation'].shape[0],
+        'u': env.action_space.shape[0],
+        'g': obs['desired_goal'].shape[0],
+    }
+    for key, value in info.items():
+        value = np.array(value)
+        if value.ndim == 0:
+            value = value.reshape(1)
+        dims['info_{}'.format(key)] = value.shape[0]
+    spec = {
+        'T': env._max_episode_steps,
+        'dims': dims,
+        # reward parameters, None for envs without them
+        'distance_threshold': getattr(env.unwrapped, 'distance_threshold', None),
+        'reward_type': getattr(env.unwrapped, 'reward_type', None),
+    }
+    env.close()
+    return spec
+
+
+def get_env_spec(env_name, make_env, cache_dir=None):
+    """Returns the spec (horizon, dims and reward parameters) of `env_name`. Specs are cached in
+    memory and in env_specs.json in `cache_dir`, and only MPI rank 0 probes an environment it finds
+    in neither; the other ranks receive its spec.
+    """
+    key = env_spec_key(env_name)
+    if key not in ENV_SPECS:
+        spec = None
+        if MPI.COMM_WORLD.Get_rank() == 0:
+            path = os.path.join(cache_dir, 'env_specs.json') if cache_dir is not None else None
+            specs = {}
+            if path is not None and os.path.exists(path):
+                with open(path) as f:
+                    specs = json.load(f)
+            if not all(field in specs.get(key, {}) for field in ENV_SPEC_FIELDS):
+                specs[key] = probe_env_spec(make_env)
+                if path is not None:
+                    with open(path, 'w') as f:
+                        json.dump(specs, f, indent=2)
+            spec = specs[key]
+        ENV_SPECS[key] = MPI.COMM_WORLD.bcast(spec, root=0)
+    return ENV_SPECS[key]
+
+
+def prepare_params(kwargs, cache_dir=None):
     # DDPG params
     ddpg_params = dict()
 
@@ -72,22 +155,22 @@ def prepare_params(kwargs):
     def make_env():
         return gym.make(env_name)
     kwargs['make_env'] = make_env
-    tmp_env = cached_make_env(kwargs['make_env'])
-    assert hasattr(tmp_env, '_max_episode_steps')
-    kwargs['T'] = tmp_env._max_episode_steps
-    tmp_env.reset()
+    kwargs['env_spec'] = get_env_spec(env_name, make_env, cache_dir=cache_dir)
+    kwargs['T'] = kwargs['env_spec']['T']
     kwargs['max_u'] = np.array(kwargs['max_u']) if isinstance(kwargs['max_u'], list) else kwargs['max_u']
     kwargs['gamma'] = 1. - 1. / kwargs['T']
     if 'lr' in kwargs:
         kwargs['pi_lr'] = kwargs['lr']
         kwargs['Q_lr'] = kwargs['lr']
         del kwargs['lr']
-    for name in ['buffer_size', 'hidden', 'layers',
+    for name in ['buffer_size', 'buffer_dtype', 'hidden', 'layers',
                  'network_class',
                  'polyak',
                  'batch_size', 'Q_lr', 'pi_lr',
                  'norm_eps', 'norm_clip', 'max_u',
-                 'action_l2', 'clip_obs', 'scope', 'relative_goals']:
+                 'action_l2', 'clip_obs', 'scope', 'relative_goals',
+                 'goal_resolution', 'prefetch_batches', 'fused_train', 'fused_steps',
+                 'norm_update_interval']:
         ddpg_params[name] = kwargs[name]
         kwargs['_' + name] = kwargs[name]
         del kwargs[name]
@@ -102,11 +185,15 @@ def log_params(params, logger=logger):
 
 
 def configure_her(params):
-    env = cached_make_env(params['make_env'])
-    env.reset()
+    spec = params['env_spec']
+    if spec['distance_threshold'] is not None and spec['reward_type'] in ['sparse', 'dense']:
+        reward_fun = dher_sample.GoalDistanceReward(spec['distance_threshold'], spec['reward_type'])
+    else:
+        env = cached_make_env(params['make_env'])
+        env.reset()
 
-    def reward_fun(ag_2, dg_2, info):  # vectorized
-        return env.compute_reward(achieved_goal=ag_2, desired_goal=dg_2, info=info)
+        def reward_fun(ag_2, dg_2, info):  # vectorized
+            return env.compute_reward(achieved_goal=ag_2, desired_goal=dg_2, info=info)
 
     # Prepare configuration for HER.
     her_params = {
@@ -137,8 +224,6 @@ def configure_ddpg(dims, params, reuse=False, use_mpi=True, clip_return=True):
     input_dims = dims.copy()
 
     # DDPG agent
-    env = cached_make_env(params['make_env'])
-    env.reset()
     ddpg_params.update({'input_dims': input_dims,  # agent takes an input observations
                         'T': params['T'],
                         'clip_pos_returns': True,  # clip positive returns
@@ -156,18 +241,4 @@ def configure_ddpg(dims, params, reuse=False, use_mpi=True, clip_return=True):
 
 
 def configure_dims(params):
-    env = cached_make_env(params['make_env'])
-    env.reset()
-    obs, _, _, info = env.step(env.action_space.sample())
-
-    dims = {
-        'o': obs['observation'].shape[0],
-        'u': env.action_space.shape[0],
-        'g': obs['desired_goal'].shape[0],
-    }
-    for key, value in info.items():
-        value = np.array(value)
-        if value.ndim == 0:
-            value = value.reshape(1)
-        dims['info_{}'.format(key)] = value.shape[0]
-    return dims
+    return dict(params['env_spec']['dims'])
@@ -1,16 +1,21 @@
+import os
+import threading
 from collections import OrderedDict
 
 import numpy as np
 import tensorflow as tf
 from tensorflow.contrib.staging import StagingArea
+from mpi4py import MPI
 
 from baselines import logger
 from baselines.her.util import (
-    import_function, store_args, flatten_grads, transitions_in_episode_batch)
+    import_function, store_args, flatten_grads)
 from baselines.her.normalizer import Normalizer
 #from dher.alg.her.normalizer import Normalizer
 # from dher.alg.her.replay_buffer import ReplayBuffer
 from dher.ddpg_dher import dher_replay_buffer
+from dher.ddpg_dher.dher_policy import postprocess_actions
+from dher.ddpg_dher.dher_timer import timer
 from baselines.common.mpi_adam import MpiAdam
 
 
@@ -23,7 +28,8 @@ class DDPG(object):
     def __init__(self, input_dims, buffer_size, hidden, layers, network_class, polyak, batch_size,
                  Q_lr, pi_lr, norm_eps, norm_clip, max_u, action_l2, clip_obs, scope, T,
                  rollout_batch_size, subtract_goals, relative_goals, clip_pos_returns, clip_return,
-                 sample_transitions, gamma, reuse=False, **kwargs):
+                 sample_transitions, gamma, goal_resolution=0.01, buffer_dtype='float32', prefetch_batches=0,
+                 fused_train=False, fused_steps=1, norm_update_interval=1, reuse=False, **kwargs):
         """Implementation of DDPG that is used in combination with Hindsight Experience Replay (HER).
 
         Args:
@@ -51,6 +57,17 @@ class DDPG(object):
             clip_return (float): clip returns to be in [-clip_return, clip_return]
             sample_transitions (function) function that samples from the replay buffer
             gamma (float): gamma used for Q learning updates
+            goal_resolution (float): grid spacing used by the replay buffer to match achieved
+                and desired goals
+            buffer_dtype (str): dtype of the arrays the replay buffer stores transitions in
+            prefetch_batches (int): number of batches a background thread keeps sampled and staged
+                ahead of train(); 0 samples and stages synchronously in train()
+            fused_train (boolean): whether or not to run the updates as single session runs with
+                Adam applied in-graph and the next batch staged alongside; single MPI worker only
+            fused_steps (int): number of updates each session run of the fused train step performs
+                on consecutive batches, staged together as one batch of fused_steps * batch_size
+            norm_update_interval (int): number of store_episode calls after which the normalizer
+                statistics are recomputed
             reuse (boolean): whether or not the networks should be reused
         """
         if self.clip_return is None:
@@ -91,13 +108,31 @@ class DDPG(object):
 
         buffer_shapes['g'] = (buffer_shapes['g'][0], self.dimg)
         buffer_shapes['ag'] = (self.T+1, self.dimg)
-
-        buffer_size = (self.buffer_size // self.rollout_batch_size) * self.rollout_batch_size
-        self.buffer = dher_replay_buffer.ReplayBuffer(buffer_shapes, buffer_size, self.T, self.sample_transitions)
+        self.buffer_shapes = buffer_shapes
+        # created on the first store_episode, so that policies loaded to act never allocate it
+        self.buffer = None
+
+        # Background staging, started on the first call to train().
+        self._prefetch_thread = None
+        self._prefetch_slots = threading.Semaphore(self.prefetch_batches)
+        # one token per batch that sits in the staging area, taken before an update dequeues it
+        self._prefetch_ready = threading.Semaphore(0)
+        self._prefetch_stop = threading.Event()
+        self._prefetch_error = None
+        self.n_norm_updates = 0
+        self.n_stores_since_norm_update = 0
+        # whether the fused train step has already staged the batch of the next update
+        self._staged_ahead = False
 
     def _random_action(self, n):
         return np.random.uniform(low=-self.max_u, high=self.max_u, size=(n, self.dimu))
 
+    def _create_buffer(self):
+        buffer_size = (self.buffer_size // self.rollout_batch_size) * self.rollout_batch_size
+        self.buffer = dher_replay_buffer.ReplayBuffer(self.buffer_shapes, buffer_size, self.T, self.sample_transitions,
+                                                      goal_resolution=self.goal_resolution,
+                                                      dtype=np.dtype(self.buffer_dtype))
+
     def _preprocess_og(self, o, ag, g):
         if self.relative_goals:
             g_shape = g.shape
@@ -125,49 +160,52 @@ class DDPG(object):
         }
 
         ret = self.sess.run(vals, feed_dict=feed)
-        # action postprocessing
-        u = ret[0]
-        noise = noise_eps * self.max_u * np.random.randn(*u.shape)  # gaussian noise
-        u += noise
-        u = np.clip(u, -self.max_u, self.max_u)
-        u += np.random.binomial(1, random_eps, u.shape[0]).reshape(-1, 1) * (self._random_action(u.shape[0]) - u)  # eps-greedy
-        if u.shape[0] == 1:
-            u = u[0]
-        u = u.copy()
-        ret[0] = u
+        ret[0] = self._postprocess_actions(ret[0], noise_eps, random_eps)
 
         if len(ret) == 1:
             return ret[0]
         else:
             return ret
 
+    def _postprocess_actions(self, u, noise_eps=0., random_eps=0.):
+        return postprocess_actions(u, self.max_u, noise_eps, random_eps)
+
     def store_episode(self, episode_batch, update_stats=True):
         """
         episode_batch: array of batch_size x (T or T+1) x dim_key
                        'o' is of size T+1, others are of size T
         """
 
-        self.buffer.store_episode(episode_batch)
-
-        if update_stats:
-            # add transitions to normalizer
-            episode_batch['o_2'] = episode_batch['o'][:, 1:, :]
-            episode_batch['ag_2'] = episode_batch['ag'][:, 1:, :]
-            episode_batch['dg_2']  = episode_batch['g'][:, 1:, :]
-            num_normalizing_transitions = transitions_in_episode_batch(episode_batch)
-            transitions = self.sample_transitions(episode_batch, num_normalizing_transitions)
-
-            o, o_2, g, ag = transitions['o'], transitions['o_2'], transitions['g'], transitions['ag']
-            transitions['o'], transitions['g'] = self._preprocess_og(o, ag, g)
-            # No need to preprocess the o_2 and g_2 since this is only used for stats
-
-            self.o_stats.update(transitions['o'])
-            self.g_stats.update(transitions['g'])
-
-            self.o_stats.recompute_stats()
-            self.g_stats.recompute_stats()
+        if self.buffer is None:
+            self._create_buffer()
+        with timer('store_episode'):
+            self.buffer.store_episode(episode_batch)
+
+        if not update_stats:
+            return
+        with timer('normalizer'):
+            # add the transitions of the episodes to the normalizers straight from the episode
+            # arrays; the DHER sampler only replays desired goals, so those are all g_stats sees
+            o = episode_batch['o'][:, :self.T].reshape(-1, self.dimo)
+            ag = episode_batch['ag'][:, :self.T].reshape(-1, self.dimg)
+            g = episode_batch['g'][:, :self.T].reshape(-1, self.dimg)
+            o, g = self._preprocess_og(o, ag, g)
+
+            self.o_stats.update(o)
+            self.g_stats.update(g)
+
+            # recomputing reduces over all MPI workers; they may drop different numbers of faulty
+            # episodes, but all call store_episode once per cycle, so the calls are counted
+            self.n_stores_since_norm_update += 1
+            if self.n_norm_updates == 0 or self.n_stores_since_norm_update >= self.norm_update_interval:
+                self.o_stats.recompute_stats()
+                self.g_stats.recompute_stats()
+                self.n_norm_updates += 1
+                self.n_stores_since_norm_update = 0
 
     def get_current_buffer_size(self):
+        if self.buffer is None:
+            return 0
         return self.buffer.get_current_size()
 
     def _sync_optimizers(self):
@@ -176,20 +214,27 @@ class DDPG(object):
 
     def _grads(self):
         # Avoid feed_dict here for performance!
-        critic_loss, actor_loss, Q_grad, pi_grad = self.sess.run([
-            self.Q_loss_tf,
-            self.main.Q_pi_tf,
-            self.Q_grad_tf,
-            self.pi_grad_tf
-        ])
+        with timer('grads'):
+            critic_loss, actor_loss, Q_grad, pi_grad = self.sess.run([
+                self.Q_loss_tf,
+                self.main.Q_pi_tf,
+                self.Q_grad_tf,
+                self.pi_grad_tf
+            ])
         return critic_loss, actor_loss, Q_grad, pi_grad
 
     def _update(self, Q_grad, pi_grad):
-        self.Q_adam.update(Q_grad, self.Q_lr)
-        self.pi_adam.update(pi_grad, self.pi_lr)
-
-    def sample_batch(self):
-        transitions = self.buffer.sample(self.batch_size)
+        with timer('adam'):
+            self.Q_adam.update(Q_grad, self.Q_lr)
+            self.pi_adam.update(pi_grad, self.pi_lr)
+
+    def sample_batch(self, batch_size=None):
+        assert self.buffer is not None, 'no episodes have been stored yet'
+        if batch_size is None:
+            # the fused train step consumes the batches of all its updates at once
+            batch_size = self.batch_size * (self.fused_steps if self.fused_train else 1)
+        with timer('sample'):
+            transitions = self.buffer.sample(batch_size)
         o, o_2, g = transitions['o'], transitions['o_2'], transitions['g']
         ag, ag_2 = transitions['ag'], transitions['ag_2']
         transitions['o'], transitions['g'] = self._preprocess_og(o, ag, g)
@@ -202,23 +247,135 @@ class DDPG(object):
         if batch is None:
             batch = self.sample_batch()
         assert len(self.buffer_ph_tf) == len(batch)
-        self.sess.run(self.stage_op, feed_dict=dict(zip(self.buffer_ph_tf, batch)))
-
-    def train(self, stage=True, learning_factor_flag = False):
+        with timer('stage'):
+            self.sess.run(self.stage_op, feed_dict=dict(zip(self.buffer_ph_tf, batch)))
+
+    def _prefetch(self):
+        try:
+            while not self._prefetch_stop.is_set():
+                # one slot per batch that may sit in the staging area
+                if self._prefetch_slots.acquire(timeout=0.1):
+                    self.stage_batch()
+                    self._prefetch_ready.release()
+        except Exception as e:
+            self._prefetch_error = e
+
+    def _wait_for_prefetch(self, timeout=1.):
+        """Blocks until a prefetched batch is staged, so that the update never waits on an empty
+        staging area. Errors of the prefetch thread are raised here.
+        """
+        while not self._prefetch_ready.acquire(timeout=timeout):
+            if self._prefetch_error is not None:
+                raise self._prefetch_error
+            if self._prefetch_thread is None or not self._prefetch_thread.is_alive():
+                raise RuntimeError('the prefetch thread is not running')
+
+    def start_prefetch(self):
+        if self._prefetch_thread is None:
+            self._prefetch_stop.clear()
+            self._prefetch_thread = threading.Thread(target=self._prefetch, daemon=True)
+            self._prefetch_thread.start()
+
+    def stop_prefetch(self):
+        """Stops the prefetch thread. Batches already staged are consumed by the next updates.
+        """
+        if self._prefetch_thread is not None:
+            self._prefetch_stop.set()
+            self._prefetch_thread.join()
+            self._prefetch_thread = None
+
+    def _train_fused(self, stage, update_target_net):
+        fetches = [self.fused_Q_loss_tf, self.fused_Q_pi_tf,
+                   self.fused_train_target_op if update_target_net else self.fused_train_op]
+        feed_dict = None
         if stage:
-            self.stage_batch()
-        critic_loss, actor_loss, Q_grad, pi_grad = self._grads()
-        self._update(Q_grad, pi_grad)
+            if not self._staged_ahead:
+                self.stage_batch()
+                self._staged_ahead = True
+            # stage the batch of the next update in the same run
+            fetches.append(self.stage_op)
+            feed_dict = dict(zip(self.buffer_ph_tf, self.sample_batch()))
+        with timer('fused_update'):
+            critic_loss, actor_loss = self.sess.run(fetches, feed_dict=feed_dict)[:2]
+        return critic_loss, actor_loss
+
+    def train(self, stage=True, learning_factor_flag = False, update_target_net=False):
+        """Performs one update on a staged batch, or `fused_steps` updates in fused mode, and, if
+        `update_target_net` is set, moves the target network afterwards.
+        """
+        prefetch = stage and self.prefetch_batches > 0
+        if prefetch:
+            self.start_prefetch()
+            self._wait_for_prefetch()
+            stage = False
+        if self.fused_train:
+            critic_loss, actor_loss = self._train_fused(stage, update_target_net)
+        else:
+            if stage:
+                self.stage_batch()
+            critic_loss, actor_loss, Q_grad, pi_grad = self._grads()
+            self._update(Q_grad, pi_grad)
+            if update_target_net:
+                self.update_target_net()
+        if prefetch:
+            self._prefetch_slots.release()
         return critic_loss, actor_loss
 
     def _init_target_net(self):
         self.sess.run(self.init_target_net_op)
 
     def update_target_net(self):
-        self.sess.run(self.update_target_net_op)
+        with timer('target_update'):
+            self.sess.run(self.update_target_net_op)
 
     def clear_buffer(self):
-        self.buffer.clear_buffer()
+        if self.buffer is not None:
+            self.buffer.clear_buffer()
+
+    def save_checkpoint(self, path):
+        """Saves everything training needs to continue into the directory `path`: the TensorFlow
+        variables, the MpiAdam moments, the normalizer sums not yet folded into the statistics and
+        the replay buffer. Unlike pickling, this keeps the optimizer and buffer state.
+        """
+        os.makedirs(path, exist_ok=True)
+        if self.buffer is not None:
+            self.buffer.save(os.path.join(path, 'buffer'))
+
+        variables = self._global_vars('')
+        state = {'tf/' + var.name: val for var, val in zip(variables, self.sess.run(variables))}
+        for name, adam in (('Q_adam', self.Q_adam), ('pi_adam', self.pi_adam)):
+            state[name + '/m'], state[name + '/v'], state[name + '/t'] = adam.m, adam.v, np.array(adam.t)
+        for name, stats in (('o_stats', self.o_stats), ('g_stats', self.g_stats)):
+            with stats.lock:
+                for attr in ['local_sum', 'local_sumsq', 'local_count']:
+                    state[name + '/' + attr] = getattr(stats, attr).copy()
+        state['n_norm_updates'] = np.array(self.n_norm_updates)
+        state['n_stores_since_norm_update'] = np.array(self.n_stores_since_norm_update)
+        with open(os.path.join(path, 'policy.npz.tmp'), 'wb') as f:
+            np.savez(f, **state)
+        os.replace(os.path.join(path, 'policy.npz.tmp'), os.path.join(path, 'policy.npz'))
+
+    def load_checkpoint(self, path):
+        """Restores a checkpoint written by `save_checkpoint` into this policy, which has to be
+        configured like the one that saved it.
+        """
+        if os.path.exists(os.path.join(path, 'buffer')):
+            if self.buffer is None:
+                self._create_buffer()
+            self.buffer.load(os.path.join(path, 'buffer'))
+
+        state = np.load(os.path.join(path, 'policy.npz'))
+        variables = self._global_vars('')
+        assert all('tf/' + var.name in state for var in variables), 'the checkpoint does not match the graph'
+        self.sess.run([tf.assign(var, state['tf/' + var.name]) for var in variables])
+        for name, adam in (('Q_adam', self.Q_adam), ('pi_adam', self.pi_adam)):
+            adam.m, adam.v, adam.t = state[name + '/m'], state[name + '/v'], int(state[name + '/t'])
+        for name, stats in (('o_stats', self.o_stats), ('g_stats', self.g_stats)):
+            with stats.lock:
+                for attr in ['local_sum', 'local_sumsq', 'local_count']:
+                    setattr(stats, attr, state[name + '/' + attr])
+        self.n_norm_updates = int(state['n_norm_updates'])
+        self.n_stores_since_norm_update = int(state['n_stores_since_norm_update'])
 
     def _vars(self, scope):
         res = tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES, scope=self.scope + '/' + scope)
@@ -298,17 +455,101 @@ class DDPG(object):
         self.update_target_net_op = list(
             map(lambda v: v[0].assign(self.polyak * v[0] + (1. - self.polyak) * v[1]), zip(self.target_vars, self.main_vars)))
 
+        # fused train step
+        if self.fused_train:
+            assert MPI.COMM_WORLD.Get_size() == 1, 'the fused train step does not average gradients across MPI workers'
+            with tf.variable_scope('fused'):
+                self._create_fused_train(batch_tf)
+
         # initialize all variables
         tf.variables_initializer(self._global_vars('')).run()
         self._sync_optimizers()
         self._init_target_net()
 
+    def _fused_nets(self, batch, params):
+        """Losses and Q values of one update built from the tensors `params` of the variables
+        instead of the variables themselves, mirroring baselines.her.actor_critic:ActorCritic.
+        """
+        def mlp(x, net):
+            layers = list(zip(params[net][::2], params[net][1::2]))
+            for W, b in layers[:-1]:
+                x = tf.nn.relu(tf.matmul(x, W) + b)
+            W, b = layers[-1]
+            return tf.matmul(x, W) + b
+
+        def actor_critic(o, g, prefix):
+            o, g = self.o_stats.normalize(o), self.g_stats.normalize(g)
+            pi = self.max_u * tf.tanh(mlp(tf.concat(axis=1, values=[o, g]), prefix + '/pi'))
+            Q_pi = mlp(tf.concat(axis=1, values=[o, g, pi / self.max_u]), prefix + '/Q')
+            return o, g, pi, Q_pi
+
+        o, g, pi, Q_pi = actor_critic(batch['o'], batch['g'], 'main')
+        Q = mlp(tf.concat(axis=1, values=[o, g, batch['u'] / self.max_u]), 'main/Q')
+        target_Q_pi = actor_critic(batch['o_2'], batch['g_2'], 'target')[3]
+
+        clip_range = (-self.clip_return, 0. if self.clip_pos_returns else np.inf)
+        target = tf.clip_by_value(batch['r'] + self.gamma * target_Q_pi, *clip_range)
+        Q_loss = tf.reduce_mean(tf.square(tf.stop_gradient(target) - Q))
+        pi_loss = -tf.reduce_mean(Q_pi) + self.action_l2 * tf.reduce_mean(tf.square(pi / self.max_u))
+        return Q_loss, pi_loss, Q_pi
+
+    def _create_fused_train(self, batch_tf, beta1=0.9, beta2=0.999, epsilon=1e-08):
+        """Builds `fused_steps` consecutive updates on the slices of one staged batch, with Adam
+        applied in-graph like MpiAdam.
+
+        Every update reads the variables again with read_value() after the previous update; the
+        cached snapshots the networks of _create_network read through are only taken once per
+        session run, and so are the beta power accumulators of tf.train.AdamOptimizer.
+        """
+        nets = ['main/Q', 'main/pi', 'target/Q', 'target/pi']
+        variables = {net: self._vars(net) for net in nets}
+        adam = {}
+        for net, lr in (('main/Q', self.Q_lr), ('main/pi', self.pi_lr)):
+            with tf.variable_scope(net.replace('main/', '') + '_adam'):
+                adam[net] = {
+                    'lr': lr,
+                    'm': [tf.Variable(np.zeros(var.get_shape().as_list(), np.float32), trainable=False, name='m')
+                          for var in variables[net]],
+                    'v': [tf.Variable(np.zeros(var.get_shape().as_list(), np.float32), trainable=False, name='v')
+                          for var in variables[net]],
+                    't': tf.Variable(0., trainable=False, name='t'),
+                }
+
+        batches = [dict(zip(batch_tf.keys(), values))
+                   for values in zip(*[tf.split(value, self.fused_steps) for value in batch_tf.values()])]
+        update_ops = []
+        for batch in batches:
+            with tf.control_dependencies(update_ops):
+                params = {net: [var.read_value() for var in variables[net]] for net in nets}
+                Q_loss, pi_loss, Q_pi = self._fused_nets(batch, params)
+                grads = {'main/Q': tf.gradients(Q_loss, params['main/Q']),
+                         'main/pi': tf.gradients(pi_loss, params['main/pi'])}
+            # both updates wait for all gradients, so they are computed from the same variables
+            with tf.control_dependencies(grads['main/Q'] + grads['main/pi'] + [Q_loss, Q_pi]):
+                update_ops = []
+                for net in ['main/Q', 'main/pi']:
+                    opt = adam[net]
+                    t = opt['t'].assign_add(1.)
+                    a = opt['lr'] * tf.sqrt(1. - beta2 ** t) / (1. - beta1 ** t)
+                    for var, value, grad, m, v in zip(variables[net], params[net], grads[net], opt['m'], opt['v']):
+                        m_t = m.assign(beta1 * m.read_value() + (1. - beta1) * grad)
+                        v_t = v.assign(beta2 * v.read_value() + (1. - beta2) * tf.square(grad))
+                        update_ops.append(var.assign(value - a * m_t / (tf.sqrt(v_t) + epsilon)))
+        self.fused_Q_loss_tf, self.fused_Q_pi_tf = Q_loss, Q_pi
+        self.fused_train_op = tf.group(*update_ops)
+        with tf.control_dependencies([self.fused_train_op]):
+            self.fused_train_target_op = tf.group(*[
+                target.assign(self.polyak * target.read_value() + (1. - self.polyak) * main.read_value())
+                for target, main in zip(self.target_vars, self.main_vars)])
+
     def logs(self, prefix=''):
         logs = []
         logs += [('stats_o/mean', np.mean(self.sess.run([self.o_stats.mean])))]
         logs += [('stats_o/std', np.mean(self.sess.run([self.o_stats.std])))]
         logs += [('stats_g/mean', np.mean(self.sess.run([self.g_stats.mean])))]
         logs += [('stats_g/std', np.mean(self.sess.run([self.g_stats.std])))]
+        memory = self.buffer.get_memory_footprint() if self.buffer is not None else 0
+        logs += [('buffer/memory_mb', memory / 2. ** 20)]
 
         if prefix is not '' and not prefix.endswith('/'):
             return [(prefix + '/' + key, val) for key, val in logs]
@@ -320,10 +561,11 @@ class DDPG(object):
         """
         excluded_subnames = ['_tf', '_op', '_vars', '_adam', 'buffer', 'sess', '_stats',
                              'main', 'target', 'lock', 'env', 'sample_transitions',
-                             'stage_shapes', 'create_actor_critic']
+                             'stage_shapes', 'create_actor_critic', '_prefetch', '_staged']
 
         state = {k: v for k, v in self.__dict__.items() if all([not subname in k for subname in excluded_subnames])}
         state['buffer_size'] = self.buffer_size
+        state['buffer_dtype'] = self.buffer_dtype
         state['tf'] = self.sess.run([x for x in self._global_vars('') if 'buffer' not in x.name])
         return state
 
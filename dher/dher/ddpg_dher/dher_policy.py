@@ -0,0 +1,103 @@
+import numpy as np
+
+
+def postprocess_actions(u, max_u, noise_eps=0., random_eps=0.):
+    """Adds Gaussian noise to the actions `u` (n x dimu), clips them to [-max_u, max_u] and
+    replaces each of them by a uniformly random action with probability `random_eps`.
+    """
+    noise = noise_eps * max_u * np.random.randn(*u.shape)  # gaussian noise
+    u += noise
+    u = np.clip(u, -max_u, max_u)
+    u += np.random.binomial(1, random_eps, u.shape[0]).reshape(-1, 1) * (
+        np.random.uniform(low=-max_u, high=max_u, size=u.shape) - u)  # eps-greedy
+    if u.shape[0] == 1:
+        u = u[0]
+    return u.copy()
+
+
+def policy_params(policy, include_Q=True):
+    """Reads the main actor (and critic) weights and the normalizer statistics of a DDPG policy
+    built with baselines.her.actor_critic:ActorCritic into a dict of arrays.
+    """
+    nets = ['pi', 'Q'] if include_Q else ['pi']
+    variables = {net: policy._vars('main/' + net) for net in nets}
+    stats = {'o_stats/mean': policy.o_stats.mean, 'o_stats/std': policy.o_stats.std,
+             'g_stats/mean': policy.g_stats.mean, 'g_stats/std': policy.g_stats.std}
+    values = policy.sess.run([variables, stats])
+
+    params = dict(values[1])
+    for net in nets:
+        # dense layers in creation order, kernel before bias
+        for i, (W, b) in enumerate(zip(values[0][net][::2], values[0][net][1::2])):
+            params['{}/W{}'.format(net, i)] = W
+            params['{}/b{}'.format(net, i)] = b
+    for name in ['dimo', 'dimg', 'dimu', 'max_u', 'norm_clip', 'clip_obs', 'relative_goals']:
+        params[name] = np.asarray(getattr(policy, name))
+    return params
+
+
+def export_policy(policy, path):
+    """Writes the parameters needed to act with `policy` to the .npz file `path`, to be loaded
+    with load_policy without TensorFlow.
+    """
+    np.savez(path, **policy_params(policy))
+
+
+def load_policy(path):
+    """Loads a policy written by export_policy as a NumpyPolicy.
+    """
+    with np.load(path) as f:
+        return NumpyPolicy({key: f[key] for key in f.files})
+
+
+def _mlp(x, layers):
+    for W, b in layers[:-1]:
+        x = np.maximum(x.dot(W) + b, 0.)
+    W, b = layers[-1]
+    return x.dot(W) + b
+
+
+class NumpyPolicy:
+    def __init__(self, params):
+        """Acts like DDPG.get_actions with the main networks of a DDPG policy, using NumPy only.
+
+        Args:
+            params (dict of arrays): the parameters as returned by policy_params
+        """
+        self.set_params(params)
+
+    def set_params(self, params):
+        def layers(net):
+            n = sum(key.startswith(net + '/W') for key in params)
+            return [(params['{}/W{}'.format(net, i)], params['{}/b{}'.format(net, i)]) for i in range(n)]
+
+        net_params = dict(params)
+        net_params['pi'] = layers('pi')
+        net_params['Q'] = layers('Q')
+        for name in ['dimo', 'dimg', 'dimu']:
+            net_params[name] = int(params[name])
+        net_params['relative_goals'] = bool(params['relative_goals'])
+        # swapped in as a whole so that a concurrent get_actions sees either the old or new params
+        self.params = net_params
+
+    def get_actions(self, o, ag, g, noise_eps=0., random_eps=0., use_target_net=False,
+                    compute_Q=False):
+        assert not use_target_net, 'only the main networks are available'
+        p = self.params
+        assert not compute_Q or p['Q'], 'the critic was not exported'
+        o = o.reshape(-1, p['dimo'])
+        g = g.reshape(-1, p['dimg'])
+        if p['relative_goals']:
+            g = g - ag.reshape(-1, p['dimg'])
+        o = np.clip(o, -p['clip_obs'], p['clip_obs'])
+        g = np.clip(g, -p['clip_obs'], p['clip_obs'])
+        o = np.clip((o - p['o_stats/mean']) / p['o_stats/std'], -p['norm_clip'], p['norm_clip'])
+        g = np.clip((g - p['g_stats/mean']) / p['g_stats/std'], -p['norm_clip'], p['norm_clip'])
+
+        u = p['max_u'] * np.tanh(_mlp(np.concatenate([o, g], axis=1), p['pi']))
+        if compute_Q:
+            Q = _mlp(np.concatenate([o, g, u / p['max_u']], axis=1), p['Q'])
+        u = postprocess_actions(u, p['max_u'], noise_eps, random_eps)
+        if compute_Q:
+            return [u, Q]
+        return u
@@ -1,10 +1,35 @@
+import json
+import os
 import threading
 import numpy as np
 from collections import deque
+from itertools import compress, repeat
+
+
+def quantize_goals(goals, resolution):
+    """Maps goals onto the cells of an integer grid with spacing `resolution`.
+
+    Args:
+        goals (array): goals of shape (..., dim_goal)
+        resolution (float): the grid spacing; goals within the same cell share a key
+
+    Returns:
+        an int64 array of shape goals.shape[:-1] with one packed key per goal
+    """
+    dim = goals.shape[-1]
+    bits = 63 // dim
+    offset = 1 << (bits - 1)
+    mask = (1 << bits) - 1
+    cells = np.round(goals / resolution).astype(np.int64) + offset
+    keys = np.zeros(goals.shape[:-1], dtype=np.int64)
+    for d in range(dim):
+        keys = (keys << bits) | (cells[..., d] & mask)
+    return keys
 
 
 class ReplayBuffer:
-    def __init__(self, buffer_shapes, size_in_transitions, T, sample_transitions):
+    def __init__(self, buffer_shapes, size_in_transitions, T, sample_transitions, goal_resolution=0.01,
+                 dtype=np.float32):
         """Creates a replay buffer.
 
         Args:
@@ -13,20 +38,44 @@ class ReplayBuffer:
             size_in_transitions (int): the size of the buffer, measured in transitions
             T (int): the time horizon for episodes
             sample_transitions (function): a function that samples from the replay buffer
+            goal_resolution (float): the grid spacing used to match achieved and desired goals
+            dtype (numpy dtype): the dtype the transitions are stored with
         """
         self.buffer_shapes = buffer_shapes
         self.size = size_in_transitions // T
         self.T = T
         self.sample_transitions = sample_transitions
+        self.goal_resolution = goal_resolution
 
+        # goal key -> flat slot (episode * T + t) of its most recent occurrence
         self.achieve_hash = {}
         self.desire_hash = {}
+        # goal key -> row of inter_table
         self.inter_hash = {}
+        # rows [0, n_inter) hold the (ac_i, ac_j, de_i, de_j) of an achieved and a desired
+        # occurrence of the same goal; inter_mask flags the rows whose desired episode failed
+        self.inter_table = np.zeros([1024, 4], dtype=np.int32)
+        self.inter_keys = np.zeros(1024, dtype=np.int64)
+        self.inter_mask = np.zeros(1024, dtype=bool)
+        self.n_inter = 0
+        self.episode_success = np.zeros(self.size, dtype=bool)
+        # goal keys of every stored time step, needed to evict episodes from the hash tables
+        self.achieve_keys = np.zeros([self.size, self.T], dtype=np.int64)
+        self.desire_keys = np.zeros([self.size, self.T], dtype=np.int64)
+        # whether a time step is the one its goal key maps to in achieve_hash / desire_hash
+        self.achieve_owner = np.zeros([self.size, self.T], dtype=bool)
+        self.desire_owner = np.zeros([self.size, self.T], dtype=bool)
+
+        # episodes, ownership flags and intersection rows changed since the last save
+        self.dirty = np.zeros(self.size, dtype=bool)
+        self.owner_dirty = np.zeros(self.size, dtype=bool)
+        self.inter_dirty = np.zeros(len(self.inter_table), dtype=bool)
+        self.saved_path = None
 
         self.recent_history = deque(maxlen=100)
         
         # self.buffers is {key: array(size_in_episodes x T or T+1 x dim_key)}
-        self.buffers = {key: np.empty([self.size, *shape])
+        self.buffers = {key: np.empty([self.size, *shape], dtype=dtype)
                         for key, shape in buffer_shapes.items()}
 
         self.buffers['o_2'] = self.buffers['o'][:, 1:, :]
@@ -48,23 +97,15 @@ class ReplayBuffer:
     def sample(self, batch_size):
         """Returns a dict {key: array(batch_size x shapes[key])}
         """
-        buffers = {}
-
         with self.lock:
             assert self.current_size > 0
-            for key in self.buffers.keys():
-                buffers[key] = self.buffers[key][:self.current_size]
-
-        buffers['o_2'] = buffers['o'][:, 1:, :]
-        buffers['ag_2'] = buffers['ag'][:, 1:, :]
-        buffers['dg_2'] = buffers['g'][:, 1:, :]
-
-
-        # print(self.inter_hash)
-        successful = np.amax(np.array(self.recent_history), axis = 1)
-        success_rate = np.mean(successful)
-            
-        transitions = self.sample_transitions(buffers, batch_size, intersection_hash = self.inter_hash, success_rate=success_rate)
+            success_rate = np.mean(self.recent_history)
+            # the sampler only gathers the rows it selects, so the buffers are passed whole
+            transitions = self.sample_transitions(self.buffers, batch_size,
+                                                  n_episodes=self.current_size,
+                                                  intersections=self.inter_table[:self.n_inter],
+                                                  intersection_mask=self.inter_mask[:self.n_inter],
+                                                  success_rate=success_rate)
 
         for key in (['r', 'o_2', 'ag_2'] + list(self.buffers.keys())):
             assert key in transitions, "key %s missing from transitions" % key
@@ -77,31 +118,12 @@ class ReplayBuffer:
         batch_sizes = [len(episode_batch[key]) for key in episode_batch.keys()]
         assert np.all(np.array(batch_sizes) == batch_sizes[0])
         batch_size = batch_sizes[0]
-        achieve_key = 'ag_2'
-        desire_key = 'dg_2'
 
         with self.lock:
-            idxs = self._get_storage_idx(batch_size)
+            idxs = np.atleast_1d(self._get_storage_idx(batch_size))
             if self.current_size >= self.size:
-                old_achieve_points = self.buffers[achieve_key][idxs]
-                old_desire_points = self.buffers[desire_key][idxs]
                 # delete old episodes from hash tables
-
-                for i in idxs:
-                    for j in range(self.T):
-                        ac_pos = self.buffers[achieve_key][i, j]
-                        de_pos = self.buffers[desire_key][i, j]
-                        ac_pos = ("%.2f,%.2f,%.2f" % (ac_pos[0], ac_pos[1], ac_pos[2]))
-                        de_pos = ("%.2f,%.2f,%.2f" % (de_pos[0], de_pos[1], de_pos[2]))
-
-                        if ac_pos in self.achieve_hash and self.achieve_hash[ac_pos] == (i, j):
-                            del self.achieve_hash[ac_pos]
-                            if ac_pos in self.inter_hash and self.inter_hash[ac_pos][0] == i and self.inter_hash[ac_pos][1] == j:
-                                del self.inter_hash[ac_pos]
-                        if de_pos in self.desire_hash and self.desire_hash[de_pos] == (i, j):
-                            del self.desire_hash[de_pos]
-                            if de_pos in self.inter_hash and self.inter_hash[de_pos][2] == i and self.inter_hash[de_pos][3] == j:
-                                del self.inter_hash[de_pos]
+                self._remove_from_index(idxs)
 
             # load inputs into buffers
             for key in episode_batch.keys():
@@ -110,31 +132,124 @@ class ReplayBuffer:
             self.buffers['ag_2'][idxs] = episode_batch['ag'][:, 1:, :]
             self.buffers['dg_2'][idxs] = episode_batch['g'][:, 1:, :]
 
-
-            # add new episodes into hash tables                
-            for i in idxs:
-                self.recent_history.append(self.buffers['info_is_success'][i])
-                for j in range(self.T):
-                    ac_pos = self.buffers[achieve_key][i, j]
-                    de_pos = self.buffers[desire_key][i, j]
-                    ac_pos = ("%.2f,%.2f,%.2f" % (ac_pos[0], ac_pos[1], ac_pos[2]))
-                    de_pos = ("%.2f,%.2f,%.2f" % (de_pos[0], de_pos[1], de_pos[2]))
-                    self.achieve_hash[ac_pos] = (i, j)
-                    self.desire_hash[de_pos] = (i, j)
-
-            for i in idxs:
-                for j in range(self.T):
-                    ac_pos = self.buffers[achieve_key][i, j]
-                    de_pos = self.buffers[desire_key][i, j]
-                    ac_pos = ("%.2f,%.2f,%.2f" % (ac_pos[0], ac_pos[1], ac_pos[2]))
-                    de_pos = ("%.2f,%.2f,%.2f" % (de_pos[0], de_pos[1], de_pos[2]))
-                    if ac_pos in self.desire_hash and i != self.desire_hash[ac_pos][0]:
-                        self.inter_hash[ac_pos] = (i, j, self.desire_hash[ac_pos][0], self.desire_hash[ac_pos][1])
-                    if de_pos in self.achieve_hash and i != self.achieve_hash[de_pos][0]:
-                        self.inter_hash[de_pos] = (self.achieve_hash[de_pos][0], self.achieve_hash[de_pos][1], i, j)
+            # add new episodes into hash tables
+            self.episode_success[idxs] = np.amax(
+                self.buffers['info_is_success'][idxs].reshape(len(idxs), -1), axis=1) > 0
+            self.recent_history.extend(self.episode_success[idxs])
+            self.dirty[idxs] = True
+            self._add_to_index(idxs)
 
             self.n_transitions_stored += batch_size * self.T
 
+    def _slots(self, idxs):
+        """Flat (episode * T + t) slot ids for all time steps of episodes `idxs`."""
+        return (idxs[:, None] * self.T + np.arange(self.T)).ravel()
+
+    def _remove_from_index(self, idxs):
+        """Drops the goals of episodes `idxs` from the hash tables before they are overwritten,
+        together with every intersection that refers to one of their time steps.
+        """
+        slots = self._slots(idxs)
+        for table, goal_keys, owner, side in ((self.achieve_hash, self.achieve_keys, self.achieve_owner, 0),
+                                              (self.desire_hash, self.desire_keys, self.desire_owner, 2)):
+            keys = goal_keys[idxs].ravel().tolist()
+            for k in set(compress(keys, owner[idxs].ravel())):
+                del table[k]
+
+            rows = np.fromiter(map(self.inter_hash.get, keys, repeat(-1)), np.int64, len(keys))
+            pairs = self.inter_table[rows].astype(np.int64)
+            referenced = (rows >= 0) & (pairs[:, side] * self.T + pairs[:, side + 1] == slots)
+            self._remove_intersections(np.unique(rows[referenced]))
+
+    def _add_to_index(self, idxs):
+        """Inserts the goals of the freshly stored episodes `idxs` into the hash tables and
+        records the goals they share with other episodes in the intersection table.
+
+        Returns:
+            the keys and (ac_i, ac_j, de_i, de_j) rows of the new intersections
+        """
+        slots = self._slots(idxs)
+        episodes = np.repeat(idxs, self.T)
+        ac_keys = quantize_goals(self.buffers['ag_2'][idxs], self.goal_resolution)
+        de_keys = quantize_goals(self.buffers['dg_2'][idxs], self.goal_resolution)
+        self.achieve_keys[idxs] = ac_keys
+        self.desire_keys[idxs] = de_keys
+        ac_keys, de_keys = ac_keys.ravel(), de_keys.ravel()
+        ac_list, de_list = ac_keys.tolist(), de_keys.tolist()
+
+        # later time steps win, as when inserting one by one
+        for table, keys, owner in ((self.achieve_hash, ac_list, self.achieve_owner),
+                                   (self.desire_hash, de_list, self.desire_owner)):
+            previous = np.fromiter(map(table.get, keys, repeat(-1)), np.int64, len(keys))
+            previous = previous[previous >= 0]
+            owner.flat[previous] = False
+            self.owner_dirty[previous // self.T] = True
+            table.update(zip(keys, slots.tolist()))
+            owner.flat[slots] = np.fromiter(map(table.get, keys), np.int64, len(keys)) == slots
+
+        de_of_ac = np.fromiter(map(self.desire_hash.get, ac_list, repeat(-1)), np.int64, len(ac_list))
+        ac_of_de = np.fromiter(map(self.achieve_hash.get, de_list, repeat(-1)), np.int64, len(de_list))
+        ac_valid = (de_of_ac >= 0) & (de_of_ac // self.T != episodes)
+        de_valid = (ac_of_de >= 0) & (ac_of_de // self.T != episodes)
+
+        # interleave the achieved and desired matches of every time step so that the
+        # last match of a key is the one kept in the intersection table
+        keys = np.stack([ac_keys, de_keys], axis=1).ravel()
+        ac_slots = np.stack([slots, ac_of_de], axis=1).ravel()
+        de_slots = np.stack([de_of_ac, slots], axis=1).ravel()
+        valid = np.stack([ac_valid, de_valid], axis=1).ravel()
+        keys, ac_slots, de_slots = keys[valid], ac_slots[valid], de_slots[valid]
+        rows = np.stack([ac_slots // self.T, ac_slots % self.T,
+                         de_slots // self.T, de_slots % self.T], axis=1)
+        self._set_intersections(keys, rows)
+        return keys, rows
+
+    def _set_intersections(self, keys, rows):
+        """Writes intersection `rows` for goal `keys`, replacing the rows already stored for
+        the same keys. If a key occurs several times its last row is kept.
+        """
+        last = dict(zip(keys.tolist(), range(len(keys))))
+        keys = np.fromiter(last.keys(), np.int64, len(last))
+        rows = rows[np.fromiter(last.values(), np.int64, len(last))]
+
+        pos = np.fromiter(map(self.inter_hash.get, keys.tolist(), repeat(-1)), np.int64, len(keys))
+        new = pos < 0
+        n_new = np.count_nonzero(new)
+        if self.n_inter + n_new > len(self.inter_table):
+            capacity = max(2 * len(self.inter_table), self.n_inter + n_new)
+            self.inter_table = np.resize(self.inter_table, [capacity, 4])
+            self.inter_keys = np.resize(self.inter_keys, capacity)
+            self.inter_mask = np.resize(self.inter_mask, capacity)
+            self.inter_dirty = np.resize(self.inter_dirty, capacity)
+        pos[new] = np.arange(self.n_inter, self.n_inter + n_new)
+        self.n_inter += n_new
+        self.inter_hash.update(zip(keys[new].tolist(), pos[new].tolist()))
+
+        self.inter_table[pos] = rows
+        self.inter_keys[pos] = keys
+        self.inter_mask[pos] = ~self.episode_success[rows[:, 2]]
+        self.inter_dirty[pos] = True
+
+    def _remove_intersections(self, rows):
+        """Deletes the intersection table `rows` (unique) and keeps the table compact by
+        moving the surviving rows from the end into the freed slots.
+        """
+        if len(rows) == 0:
+            return
+        for k in self.inter_keys[rows].tolist():
+            del self.inter_hash[k]
+        n = self.n_inter - len(rows)
+        holes = rows[rows < n]
+        tail = np.ones(self.n_inter - n, dtype=bool)
+        tail[rows[rows >= n] - n] = False
+        movers = np.arange(n, self.n_inter)[tail]
+        self.inter_table[holes] = self.inter_table[movers]
+        self.inter_keys[holes] = self.inter_keys[movers]
+        self.inter_mask[holes] = self.inter_mask[movers]
+        self.inter_dirty[holes] = True
+        self.inter_hash.update(zip(self.inter_keys[holes].tolist(), holes.tolist()))
+        self.n_inter = n
+
     def get_current_episode_size(self):
         with self.lock:
             return self.current_size
@@ -147,13 +262,194 @@ class ReplayBuffer:
         with self.lock:
             return self.n_transitions_stored
 
+    def get_memory_footprint(self):
+        """Returns the number of bytes held by the buffers and the goal hash tables' arrays."""
+        with self.lock:
+            arrays = [self.buffers[key] for key in self.buffer_shapes.keys()]
+            arrays += [self.achieve_keys, self.desire_keys, self.achieve_owner, self.desire_owner,
+                       self.episode_success, self.inter_table, self.inter_keys, self.inter_mask]
+            return sum(array.nbytes for array in arrays)
+
     def clear_buffer(self):
         with self.lock:
             self.current_size = 0
             self.achieve_hash = {}
             self.desire_hash = {}
             self.inter_hash = {}
+            self.n_inter = 0
+
+    def _episode_arrays(self):
+        arrays = {key: self.buffers[key] for key in self.buffer_shapes.keys()}
+        arrays.update(achieve_keys=self.achieve_keys, desire_keys=self.desire_keys,
+                      episode_success=self.episode_success)
+        return arrays
+
+    def _owner_arrays(self):
+        return dict(achieve_owner=self.achieve_owner, desire_owner=self.desire_owner)
+
+    def _inter_arrays(self):
+        return dict(inter_table=self.inter_table, inter_keys=self.inter_keys, inter_mask=self.inter_mask)
+
+    @staticmethod
+    def _open_stored(path, name, shape, dtype):
+        """Opens the .npy file `name` in `path` for writing if it matches `shape` and `dtype`."""
+        try:
+            stored = np.load(os.path.join(path, name + '.npy'), mmap_mode='r+')
+        except (IOError, ValueError):
+            return None
+        if stored.shape != tuple(shape) or stored.dtype != dtype:
+            return None
+        return stored
+
+    def _updates(self, path, rows_of):
+        """The rows of every array that a save to `path` writes, as {name: (rows, values, shape)}.
+        Arrays whose file is missing or does not match are written from their first row on.
+        """
+        updates = {}
+        groups = ((self._episode_arrays(), 'episodes', self.current_size),
+                  (self._owner_arrays(), 'owners', self.current_size),
+                  (self._inter_arrays(), 'inters', self.n_inter))
+        for arrays, group, n_rows in groups:
+            for name, array in arrays.items():
+                rows = rows_of[group]
+                if self._open_stored(path, name, array.shape, array.dtype) is None:
+                    rows = np.arange(n_rows)
+                updates[name] = (rows, array[rows], array.shape)
+        return updates
+
+    @staticmethod
+    def _write_atomic(filename, write):
+        with open(filename + '.tmp', 'wb') as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(filename + '.tmp', filename)
+
+    @classmethod
+    def _apply(cls, path, updates, meta):
+        """Writes the rows of `updates` into the .npy files in `path`, then the meta data. Applying
+        the same updates again gives the same files, so an interrupted apply can be repeated.
+        """
+        for name, (rows, values, shape) in updates.items():
+            stored = cls._open_stored(path, name, shape, values.dtype)
+            if stored is None:
+                stored = np.lib.format.open_memmap(os.path.join(path, name + '.npy'), mode='w+',
+                                                   dtype=values.dtype, shape=tuple(shape))
+            stored[rows] = values
+            stored.flush()
+            del stored
+        cls._write_atomic(os.path.join(path, 'meta.json'), lambda f: f.write(json.dumps(meta).encode()))
+
+    @classmethod
+    def _replay_journal(cls, path):
+        """Finishes a save that was interrupted after its journal was written."""
+        filename = os.path.join(path, 'journal.npz')
+        with np.load(filename) as journal:
+            names = [key[:-len('/rows')] for key in journal.files if key.endswith('/rows')]
+            updates = {name: (journal[name + '/rows'], journal[name + '/values'], journal[name + '/shape'])
+                       for name in names}
+            meta = json.loads(str(journal['meta']))
+        cls._apply(path, updates, meta)
+        os.remove(filename)
+
+    def save(self, path):
+        """Saves the buffer to the directory `path` as one .npy file per array plus a meta.json.
+        Saving again to the same path only writes the episodes and intersections that changed in
+        between, so it takes time proportional to the number of newly stored episodes.
+
+        Saves are crash-consistent: a first save removes the meta.json of any earlier snapshot
+        before writing, and later saves first write the changed rows to a journal that `load`
+        replays if the save was interrupted while patching the files.
+        """
+        with self.lock:
+            os.makedirs(path, exist_ok=True)
+            full = self.saved_path != os.path.abspath(path)
+            if full:
+                rows_of = dict(episodes=np.arange(self.current_size), owners=np.arange(self.current_size),
+                               inters=np.arange(self.n_inter))
+            else:
+                rows_of = dict(episodes=np.flatnonzero(self.dirty),
+                               owners=np.flatnonzero(self.dirty | self.owner_dirty),
+                               inters=np.flatnonzero(self.inter_dirty[:self.n_inter]))
+            meta = dict(size=self.size, T=self.T, goal_resolution=self.goal_resolution,
+                        current_size=self.current_size, n_transitions_stored=self.n_transitions_stored,
+                        n_inter=self.n_inter, recent_history=[bool(x) for x in self.recent_history])
+
+            if full:
+                # the snapshot stays invalid until its meta data is written again
+                for name in ['meta.json', 'journal.npz']:
+                    if os.path.exists(os.path.join(path, name)):
+                        os.remove(os.path.join(path, name))
+                self._apply(path, self._updates(path, rows_of), meta)
+            else:
+                if os.path.exists(os.path.join(path, 'journal.npz')):
+                    self._replay_journal(path)
+                updates = self._updates(path, rows_of)
+                journal = {'meta': np.array(json.dumps(meta))}
+                for name, (rows, values, shape) in updates.items():
+                    journal[name + '/rows'], journal[name + '/values'] = rows, values
+                    journal[name + '/shape'] = np.array(shape)
+                # the save is committed once the journal is in place
+                self._write_atomic(os.path.join(path, 'journal.npz'), lambda f: np.savez(f, **journal))
+                self._apply(path, updates, meta)
+                os.remove(os.path.join(path, 'journal.npz'))
+
+            self.dirty[:] = False
+            self.owner_dirty[:] = False
+            self.inter_dirty[:] = False
+            self.saved_path = os.path.abspath(path)
+
+    def load(self, path, mmap_mode='c'):
+        """Restores a buffer saved with `save`. The arrays are memory-mapped, so episodes are only
+        read from disk once they are sampled; with the default copy-on-write mode, storing new
+        episodes leaves the files untouched until the next `save`. The goal hash tables are
+        rebuilt from the stored goal keys and ownership flags. A save that was interrupted after
+        writing its journal is completed first; other interrupted saves left no snapshot.
+        """
+        if os.path.exists(os.path.join(path, 'journal.npz')):
+            self._replay_journal(path)
+        if not os.path.exists(os.path.join(path, 'meta.json')):
+            raise IOError('{} holds no complete replay buffer snapshot'.format(path))
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        assert meta['size'] == self.size and meta['T'] == self.T, 'the saved buffer has a different size'
+
+        def load_array(name, like):
+            array = np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode)
+            assert array.dtype == like.dtype and array.shape[1:] == like.shape[1:], name
+            return array
 
+        with self.lock:
+            for name, array in self._episode_arrays().items():
+                array = load_array(name, array)
+                if name in self.buffers:
+                    self.buffers[name] = array
+                else:
+                    setattr(self, name, array)
+            for name, array in self._owner_arrays().items():
+                setattr(self, name, load_array(name, array))
+            self.buffers['o_2'] = self.buffers['o'][:, 1:, :]
+            self.buffers['ag_2'] = self.buffers['ag'][:, 1:, :]
+            self.buffers['dg_2'] = self.buffers['g'][:, 1:, :]
+            for name, array in self._inter_arrays().items():
+                setattr(self, name, load_array(name, array))
+            self.inter_dirty = np.zeros(len(self.inter_table), dtype=bool)
+            self.dirty[:] = False
+            self.owner_dirty[:] = False
+
+            self.goal_resolution = meta['goal_resolution']
+            self.current_size = meta['current_size']
+            self.n_transitions_stored = meta['n_transitions_stored']
+            self.n_inter = meta['n_inter']
+            self.recent_history.clear()
+            self.recent_history.extend(meta['recent_history'])
+
+            for name, goal_keys, owner in (('achieve_hash', self.achieve_keys, self.achieve_owner),
+                                           ('desire_hash', self.desire_keys, self.desire_owner)):
+                slots = np.flatnonzero(owner[:self.current_size])
+                setattr(self, name, dict(zip(goal_keys.flat[slots].tolist(), slots.tolist())))
+            self.inter_hash = dict(zip(self.inter_keys[:self.n_inter].tolist(), range(self.n_inter)))
+            self.saved_path = os.path.abspath(path)
 
     def _get_storage_idx(self, inc=None):
         inc = inc or 1   # size increment
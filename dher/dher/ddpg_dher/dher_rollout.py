@@ -4,7 +4,9 @@ import numpy as np
 import pickle
 from mujoco_py import MujocoException
 
-from baselines.her.util import convert_episode_to_batch_major, store_args
+from baselines.her.util import store_args
+from dher.ddpg_dher.dher_timer import timer
+from dher.ddpg_dher.dher_vec_env import make_vec_env
 
 
 class RolloutWorker:
@@ -12,7 +14,8 @@ class RolloutWorker:
     @store_args
     def __init__(self, make_env, policy, dims, logger, T, rollout_batch_size=1,
                  exploit=False, use_target_net=False, compute_Q=False, noise_eps=0,
-                 random_eps=0, history_len=100, render=False, **kwargs):
+                 random_eps=0, history_len=100, render=False, vec_env='serial', max_retries=10,
+                 freeze_done=False, **kwargs):
         """Rollout worker generates experience by interacting with one or many environments.
 
         Args:
@@ -30,17 +33,27 @@ class RolloutWorker:
             random_eps (float): probability of selecting a completely random action
             history_len (int): length of history for statistics smoothing
             render (boolean): whether or not to render the rollouts
+            vec_env (str): the backend that steps the `rollout_batch_size` environments, 'serial'
+                (in process) or 'subproc' (pool of subprocesses with shared-memory observations)
+            max_retries (int): the number of faulty environment steps (MujocoException or NaN
+                observations) tolerated within one call to generate_rollouts; a faulty environment
+                is reset and its episode dropped from the batch
+            freeze_done (boolean): whether or not environments stop being stepped once they report
+                success; the rest of their episode repeats the last step and the rollout ends early
+                once every environment is done
         """
-        self.envs = [make_env() for _ in range(rollout_batch_size)]
         assert self.T > 0
 
         self.info_keys = [key.replace('info_', '')
                           for key in dims.keys() if key.startswith('info_')]
+        self.venv = make_vec_env(vec_env, make_env, rollout_batch_size, dims, self.info_keys,
+                                 recoverable_errors=(MujocoException,))
 
         self.success_history = deque(maxlen=history_len)
         self.Q_history = deque(maxlen=history_len)
 
         self.n_episodes = 0
+        self.n_retries = 0
         self.g = np.empty(
             (self.rollout_batch_size, self.dims['g']), np.float32)  # goals
         self.initial_o = np.empty(
@@ -49,6 +62,18 @@ class RolloutWorker:
             (self.rollout_batch_size, self.dims['g']), np.float32)  # achieved goals
         self.initial_dg = np.empty(
             (self.rollout_batch_size, self.dims['g']), np.float32)
+
+        # batch-major episode buffers, filled in place by every call to generate_rollouts
+        B, T = self.rollout_batch_size, self.T
+        self.episode = {
+            'o': np.empty((B, T + 1, self.dims['o']), np.float32),
+            'u': np.empty((B, T, self.dims['u']), np.float32),
+            'g': np.empty((B, T + 1, self.dims['g']), np.float32),
+            'ag': np.empty((B, T + 1, self.dims['g']), np.float32),
+        }
+        for key in self.info_keys:
+            self.episode['info_' + key] = np.empty((B, T, self.dims['info_' + key]), np.float32)
+        self.successes = np.empty((T, B), np.float32)
         self.reset_all_rollouts()
         self.clear_history()
 
@@ -56,10 +81,7 @@ class RolloutWorker:
         """Resets the `i`-th rollout environment, re-samples a new goal, and updates the `initial_o`
         and `g` arrays accordingly.
         """
-        obs = self.envs[i].reset()
-        self.initial_o[i] = obs['observation']
-        self.initial_ag[i] = obs['achieved_goal']
-        self.initial_dg[i] = obs['desired_goal']
+        self.initial_o[i], self.initial_ag[i], self.initial_dg[i] = self.venv.reset(i)
 
     def reset_all_rollouts(self):
         """Resets all `rollout_batch_size` rollout workers.
@@ -70,31 +92,63 @@ class RolloutWorker:
     def generate_rollouts(self):
         """Performs `rollout_batch_size` rollouts in parallel for time horizon `T` with the current
         policy acting on it accordingly.
+
+        The returned batch-major episode arrays are owned by the worker and overwritten by the
+        next call; copy them if they have to outlive it.
+
+        Environments that fault during the rollout are reset and their episodes are left out of
+        the returned batch, which can thus hold fewer than `rollout_batch_size` episodes. If every
+        episode is dropped, the rollouts are generated again. A RuntimeError is raised once more
+        than `max_retries` faults happened.
+        """
+        retries = 0
+        while True:
+            Qs, valid, retries = self._rollout(retries)
+            if valid.any():
+                break
+
+        episode = dict(self.episode)
+        successes = self.successes
+        if not valid.all():
+            episode = {key: value[valid] for key, value in episode.items()}
+            successes = successes[:, valid]
+
+        # stats
+        successful = np.amax(successes, axis=0)
+        assert successful.shape == (np.sum(valid),)
+        success_rate = np.mean(successful)
+        self.success_history.append(success_rate)
+        if self.compute_Q:
+            self.Q_history.append(np.mean(Qs))
+        self.n_episodes += len(successful)
+
+        return episode
+
+    def _rollout(self, retries):
+        """Runs one pass of `T` steps over all rollouts, writing into the episode buffers. Returns
+        the Q values, the mask of episodes that ran without a fault and the updated retry count.
         """
         self.reset_all_rollouts()
 
-        # compute observations
-        # observations
-        o = np.empty((self.rollout_batch_size, self.dims['o']), np.float32)
-        # achieved goals
-        ag = np.empty((self.rollout_batch_size, self.dims['g']), np.float32)
-        dg = np.empty((self.rollout_batch_size, self.dims['g']), np.float32)
+        ep = self.episode
+        # observations, achieved goals and desired goals of the current step
+        o, ag, dg = ep['o'][:, 0], ep['ag'][:, 0], ep['g'][:, 0]
         o[:] = self.initial_o
         ag[:] = self.initial_ag
         dg[:] = self.initial_dg
+        valid = np.ones(self.rollout_batch_size, dtype=bool)
+        active = np.ones(self.rollout_batch_size, dtype=bool) if self.freeze_done else None
 
         # generate episodes
-        obs, achieved_goals, desired_goals, acts, goals, successes = [], [], [], [], [], []
-        info_values = [np.empty((self.T, self.rollout_batch_size,
-                                 self.dims['info_' + key]), np.float32) for key in self.info_keys]
         Qs = []
         for t in range(self.T):
-            policy_output = self.policy.get_actions(
-                o, ag, dg,
-                compute_Q=self.compute_Q,
-                noise_eps=self.noise_eps if not self.exploit else 0.,
-                random_eps=self.random_eps if not self.exploit else 0.,
-                use_target_net=self.use_target_net)
+            with timer('act'):
+                policy_output = self.policy.get_actions(
+                    o, ag, dg,
+                    compute_Q=self.compute_Q,
+                    noise_eps=self.noise_eps if not self.exploit else 0.,
+                    random_eps=self.random_eps if not self.exploit else 0.,
+                    use_target_net=self.use_target_net)
 
             if self.compute_Q:
                 u, Q = policy_output
@@ -105,66 +159,51 @@ class RolloutWorker:
             if u.ndim == 1:
                 # The non-batched case should still have a reasonable shape.
                 u = u.reshape(1, -1)
+            ep['u'][:, t] = u
 
-            o_new = np.empty((self.rollout_batch_size, self.dims['o']))
-            ag_new = np.empty((self.rollout_batch_size, self.dims['g']))
-            dg_new = np.empty((self.rollout_batch_size, self.dims['g']))
-            success = np.zeros(self.rollout_batch_size)
             # compute new states and observations
-            for i in range(self.rollout_batch_size):
-                try:
-                    # We fully ignore the reward here because it will have to be re-computed
-                    # for HER.
-                    curr_o_new, _, _, info = self.envs[i].step(u[i])
-                    if 'is_success' in info:
-                        success[i] = info['is_success']
-                    o_new[i] = curr_o_new['observation']
-                    ag_new[i] = curr_o_new['achieved_goal']
-                    dg_new[i] = curr_o_new['desired_goal']
-                    for idx, key in enumerate(self.info_keys):
-                        info_values[idx][t, i] = info[key]
-                    if self.render:
-                        self.envs[i].render()
-                except MujocoException as e:
-                    return self.generate_rollouts()
-            # print(dg_new)
-
-            if np.isnan(o_new).any():
+            with timer('env_step'):
+                o_new, ag_new, dg_new, success, info_new, fault = self.venv.step(u, active)
+            for key, value in zip(self.info_keys, info_new):
+                ep['info_' + key][:, t] = value
+            if self.render:
+                self.venv.render()
+
+            for i in np.flatnonzero((fault > 0) | np.isnan(o_new).any(axis=1)):
+                retries += 1
+                self.n_retries += 1
+                if retries > self.max_retries:
+                    raise RuntimeError(
+                        'Rollout generation failed {} times, giving up.'.format(retries))
                 self.logger.warning(
-                    'NaN caught during rollout generation. Trying again...')
-                self.reset_all_rollouts()
-                return self.generate_rollouts()
-
-            obs.append(o.copy())
-            achieved_goals.append(ag.copy())
-            desired_goals.append(dg.copy())
-            successes.append(success.copy())
-            acts.append(u.copy())
+                    'Fault caught in rollout {} at step {}. Resetting it...'.format(i, t))
+                # the reset writes a clean observation into the rows of o_new
+                self.reset_rollout(i)
+                valid[i] = False
+
+            self.successes[t] = success
+            o, ag, dg = ep['o'][:, t + 1], ep['ag'][:, t + 1], ep['g'][:, t + 1]
             o[...] = o_new
             ag[...] = ag_new
             dg[...] = dg_new
-        obs.append(o.copy())
-        achieved_goals.append(ag.copy())
-        desired_goals.append(dg.copy())
+
+            if self.freeze_done:
+                active &= success <= 0
+                if not active.any():
+                    self._repeat_last_step(t)
+                    break
         self.initial_o[:] = o
 
-        episode = dict(o=obs,
-                       u=acts,
-                       g=desired_goals,
-                       ag=achieved_goals)
-        for key, value in zip(self.info_keys, info_values):
-            episode['info_{}'.format(key)] = value
+        return Qs, valid, retries
 
-        # stats
-        successful = np.amax(successes, axis=0)
-        assert successful.shape == (self.rollout_batch_size,)
-        success_rate = np.mean(successful)
-        self.success_history.append(success_rate)
-        if self.compute_Q:
-            self.Q_history.append(np.mean(Qs))
-        self.n_episodes += self.rollout_batch_size
-
-        return convert_episode_to_batch_major(episode)
+    def _repeat_last_step(self, t):
+        """Fills the steps after `t` of the episode buffers with copies of step `t`."""
+        ep = self.episode
+        for key in ['o', 'ag', 'g']:
+            ep[key][:, t + 2:] = ep[key][:, t + 1:t + 2]
+        for key in ['u'] + ['info_' + key for key in self.info_keys]:
+            ep[key][:, t + 1:] = ep[key][:, t:t + 1]
+        self.successes[t + 1:] = self.successes[t]
 
     def clear_history(self):
         """Clears all histories that are used for statistics
@@ -192,6 +231,7 @@ class RolloutWorker:
         if self.compute_Q:
             logs += [('mean_Q', np.mean(self.Q_history))]
         logs += [('episode', self.n_episodes)]
+        logs += [('retries', self.n_retries)]
 
         if prefix is not '' and not prefix.endswith('/'):
             return [(prefix + '/' + key, val) for key, val in logs]
@@ -201,5 +241,7 @@ class RolloutWorker:
     def seed(self, seed):
         """Seeds each environment with a distinct seed derived from the passed in global seed.
         """
-        for idx, env in enumerate(self.envs):
-            env.seed(seed + 1000 * idx)
+        self.venv.seed(seed)
+
+    def close(self):
+        self.venv.close()
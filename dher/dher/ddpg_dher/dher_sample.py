@@ -2,6 +2,27 @@ import numpy as np
 import random
 
 
+class GoalDistanceReward:
+    def __init__(self, distance_threshold, reward_type='sparse'):
+        """Vectorized goal-reaching reward of the dygym robotics envs (DyFetchEnv.compute_reward)
+        that needs no live environment, so it can be pickled into sampler processes.
+
+        Args:
+            distance_threshold (float): goals closer than this to the achieved goal are reached
+            reward_type (in ['sparse', 'dense']): 'sparse' gives -1 for unreached goals and 0 for
+                reached ones, 'dense' the negative distance plus 1 for reached goals
+        """
+        self.distance_threshold = distance_threshold
+        self.reward_type = reward_type
+
+    def __call__(self, ag_2, dg_2, info=None):
+        d = np.linalg.norm(ag_2 - dg_2, axis=-1)
+        if self.reward_type == 'sparse':
+            return -(d > self.distance_threshold).astype(np.float32)
+        else:
+            return np.where(d > self.distance_threshold, -d, -d + 1.0)
+
+
 def make_sample_her_transitions(replay_strategy, replay_k, reward_fun):
     """Creates a sample function that can be used for HER experience replay.
 
@@ -17,42 +38,40 @@ def make_sample_her_transitions(replay_strategy, replay_k, reward_fun):
     else:  # 'replay_strategy' == 'none'
         future_p = 0
 
-    def search_memory(episode_batch, intersection_hash, success_flags):
-        intersection = []
-        for key, val in intersection_hash.items():
-            ac_pos = key
-            ac_i, ac_j, find_i, find_j = val
-            if not success_flags[find_i]:
-                intersection.append((ac_i, ac_j, find_i, find_j))
-        return np.array(intersection)
-
-    def _sample_her_transitions(episode_batch, batch_size_in_transitions, intersection_hash = {}, success_rate = 0.0):
+    def _sample_her_transitions(episode_batch, batch_size_in_transitions, n_episodes=None,
+                                intersections=None, intersection_mask=None, success_rate=0.0):
         """episode_batch is {key: array(buffer_size x T x dim_key)}
+
+        Only the first n_episodes episodes are sampled from (all of them by default).
+        intersections is an (N, 4) array of (ac_i, ac_j, de_i, de_j) rows pairing an achieved
+        goal with the same desired goal of another episode, and intersection_mask flags the
+        rows that may be replayed.
         """
 
-        episode_batch['info_is_success'] = np.reshape(episode_batch['info_is_success'], episode_batch['info_is_success'].shape[:2])
-        successful = np.amax(episode_batch['info_is_success'], axis = 1)
-        
         T = episode_batch['u'].shape[1]
-        rollout_batch_size = episode_batch['u'].shape[0]
+        rollout_batch_size = episode_batch['u'].shape[0] if n_episodes is None else n_episodes
         batch_size = batch_size_in_transitions
         size2 = batch_size
 
         # Select which episodes and time steps to use
-        intersection = np.array(search_memory(episode_batch, intersection_hash, successful))
-        if len(intersection) > 0:
-            joint_rate = len(set(intersection[:, 1])) / (len(successful) - np.sum(successful))
-        else:
-            joint_rate = 0.0
-        
+        candidates = []
+        if intersections is not None:
+            if intersection_mask is None:
+                candidates = np.arange(len(intersections))
+            else:
+                candidates = np.flatnonzero(intersection_mask)
+
         inter_transitions = None
-        # print(success_rate)
-        if len(intersection) > 0:
+        if len(candidates) > 0:
+            size1 = int(future_p * batch_size * (1.0 - success_rate))
+            size2 = batch_size - size1
+            intersection = intersections[candidates[np.random.randint(0, len(candidates), size1)]]
+
             steps = np.minimum(intersection[:, 1], intersection[:, 3]) + 1.0
-            steps_array = (np.random.uniform(size=len(intersection)) * steps).astype(int)
+            steps_array = (np.random.uniform(size=size1) * steps).astype(int)
             achieve_idxs, desired_idxs = intersection[:, 0], intersection[:, 2]
             achieve_t, desired_t = intersection[:, 1] - steps_array, intersection[:, 3] - steps_array
-        
+
             inter_transitions = {key: episode_batch[key][achieve_idxs, achieve_t].copy() for key in episode_batch.keys()}
 
             new_g = episode_batch ['g'][desired_idxs, desired_t]
@@ -60,18 +79,6 @@ def make_sample_her_transitions(replay_strategy, replay_k, reward_fun):
             inter_transitions['g'] = new_g
             inter_transitions['dg_2'] = new_next_g
 
-            if replay_strategy == 'future':
-                future_p = 1 - (1. / (1 + replay_k))
-            else:  # 'replay_strategy' == 'none'
-                future_p = 0
-
-            size1 = int(future_p * batch_size * (1.0 - success_rate))
-            # size1 = int(future_p * batch_size)
-            size2 = batch_size - size1
-            idxs1 = np.random.randint(0, len(inter_transitions['u']), size1)
-            inter_transitions = {key: inter_transitions[key][idxs1] for key in inter_transitions.keys()}
-            # print(inter_transitions)
-
         idxs2 = np.random.randint(0, rollout_batch_size, size2)
         t_samples = np.random.randint(T, size=size2)
         transitions = {key: episode_batch[key][idxs2, t_samples].copy() for key in episode_batch.keys()}
@@ -0,0 +1,91 @@
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+class _Timer:
+    def __init__(self, timers, name):
+        self.timers = timers
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.timers.record(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class Timers:
+    def __init__(self, enabled=True, percentiles=(50, 90, 99)):
+        """Registry of wall-clock timings of named phases, e.g. env stepping or gradient
+        computation. A phase is timed with `with timers('name'): ...`; when the registry is
+        disabled that returns a shared no-op context manager.
+
+        Args:
+            enabled (boolean): whether or not durations are recorded
+            percentiles (tuple of ints): the percentiles of the per-call durations that are logged
+        """
+        self.enabled = enabled
+        self.percentiles = percentiles
+        # phases are never forgotten, so that every MPI worker logs the same keys
+        self.durations = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __call__(self, name):
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, name)
+
+    def record(self, name, duration):
+        with self.lock:
+            self.durations.setdefault(name, []).append(duration)
+
+    def clear(self):
+        """Forgets the recorded durations, but not the phases.
+        """
+        with self.lock:
+            for durations in self.durations.values():
+                del durations[:]
+
+    def logs(self, prefix='time'):
+        """Total seconds and percentiles of the per-call milliseconds spent in each phase since the
+        last call to clear.
+        """
+        with self.lock:
+            durations = [(name, np.array(values)) for name, values in sorted(self.durations.items())]
+        logs = []
+        for name, values in durations:
+            logs += [(name + '/total_s', np.sum(values))]
+            for q in self.percentiles:
+                value = np.percentile(values, q) * 1000. if len(values) > 0 else 0.
+                logs += [(name + '/p{}_ms'.format(q), value)]
+
+        if prefix != '' and not prefix.endswith('/'):
+            return [(prefix + '/' + key, val) for key, val in logs]
+        else:
+            return logs
+
+
+# registry shared by the DDPG DHER modules
+TIMERS = Timers()
+
+
+def timer(name):
+    """Times the phase `name` in the shared registry TIMERS.
+    """
+    return TIMERS(name)
@@ -0,0 +1,226 @@
+from multiprocessing import Process, Pipe, RawArray
+
+import numpy as np
+
+from baselines.common.vec_env import CloudpickleWrapper
+
+
+def buffer_shapes(num_envs, dims, info_keys):
+    """Shapes of the per-environment rows a vec env exchanges on every reset and step."""
+    shapes = {
+        'o': (num_envs, dims['o']),
+        'ag': (num_envs, dims['g']),
+        'dg': (num_envs, dims['g']),
+        'success': (num_envs,),
+        'fault': (num_envs,),
+    }
+    for key in info_keys:
+        shapes['info_' + key] = (num_envs, dims['info_' + key])
+    return shapes
+
+
+def write_obs(buffers, i, obs):
+    buffers['o'][i] = obs['observation']
+    buffers['ag'][i] = obs['achieved_goal']
+    buffers['dg'][i] = obs['desired_goal']
+
+
+def write_step(buffers, info_keys, i, obs, info):
+    write_obs(buffers, i, obs)
+    buffers['success'][i] = info['is_success'] if 'is_success' in info else 0.
+    for key in info_keys:
+        buffers['info_' + key][i] = info[key]
+
+
+def step_env(env, buffers, info_keys, i, u, recoverable_errors):
+    """Steps `env` and writes the results into row `i` of `buffers`. Errors of the types
+    `recoverable_errors` only flag the row as faulty.
+    """
+    try:
+        # We fully ignore the reward here because it will have to be re-computed
+        # for HER.
+        obs, _, _, info = env.step(u)
+    except recoverable_errors:
+        buffers['fault'][i] = 1.
+        return
+    buffers['fault'][i] = 0.
+    write_step(buffers, info_keys, i, obs, info)
+
+
+class SerialVecEnv:
+    def __init__(self, make_env, num_envs, dims, info_keys, recoverable_errors=()):
+        """Steps `num_envs` goal environments one after another in the current process and
+        stacks their observations.
+
+        Args:
+            make_env (function): a factory function that creates a new instance of the environment
+                when called
+            num_envs (int): the number of environments
+            dims (dict of ints): the dimensions for observations (o), goals (g), and actions (u)
+            info_keys (list of str): the info entries that are collected on every step
+            recoverable_errors (tuple of exception types): errors raised by an environment's
+                step that flag its row as faulty instead of being raised
+        """
+        self.num_envs = num_envs
+        self.info_keys = info_keys
+        self.recoverable_errors = tuple(recoverable_errors)
+        self.envs = [make_env() for _ in range(num_envs)]
+        self.buffers = {key: np.empty(shape, np.float32)
+                        for key, shape in buffer_shapes(num_envs, dims, info_keys).items()}
+
+    def _results(self):
+        b = self.buffers
+        return (b['o'], b['ag'], b['dg'], b['success'], [b['info_' + key] for key in self.info_keys],
+                b['fault'])
+
+    def reset(self, i):
+        """Resets the `i`-th environment and returns its observation, achieved and desired goal.
+        """
+        write_obs(self.buffers, i, self.envs[i].reset())
+        return self.buffers['o'][i], self.buffers['ag'][i], self.buffers['dg'][i]
+
+    def step(self, u, active=None):
+        """Steps every environment with its row of `u` and returns the stacked observations,
+        achieved goals, desired goals, success flags, info values and fault flags. The returned
+        arrays are owned by the vec env and overwritten by the next call.
+
+        If the boolean mask `active` is given, only those environments are stepped and the rows
+        of the others keep their previous values.
+        """
+        env_ids = range(self.num_envs) if active is None else np.flatnonzero(active)
+        for i in env_ids:
+            step_env(self.envs[i], self.buffers, self.info_keys, i, u[i], self.recoverable_errors)
+        return self._results()
+
+    def render(self):
+        for env in self.envs:
+            env.render()
+
+    def seed(self, seed):
+        """Seeds each environment with a distinct seed derived from the passed in global seed.
+        """
+        for idx, env in enumerate(self.envs):
+            env.seed(seed + 1000 * idx)
+
+    def close(self):
+        for env in self.envs:
+            env.close()
+
+
+def shared_array(raw, shape):
+    return np.frombuffer(raw, dtype=np.float32).reshape(shape)
+
+
+def worker(remote, parent_remote, env_fn_wrapper, raw_buffers, info_keys, env_ids, recoverable_errors):
+    parent_remote.close()
+    buffers = {key: shared_array(raw, shape) for key, (raw, shape) in raw_buffers.items()}
+    envs = {i: env_fn_wrapper.x() for i in env_ids}
+    while True:
+        cmd, data = remote.recv()
+        try:
+            if cmd == 'step':
+                for i in env_ids:
+                    if buffers['active'][i]:
+                        step_env(envs[i], buffers, info_keys, i, buffers['u'][i], recoverable_errors)
+            elif cmd == 'reset':
+                write_obs(buffers, data, envs[data].reset())
+            elif cmd == 'seed':
+                for i in env_ids:
+                    envs[i].seed(data + 1000 * i)
+            elif cmd == 'render':
+                for i in env_ids:
+                    envs[i].render()
+            elif cmd == 'close':
+                for i in env_ids:
+                    envs[i].close()
+                remote.close()
+                break
+            else:
+                raise NotImplementedError
+            remote.send(None)
+        except Exception as e:
+            remote.send(e)
+
+
+class SubprocVecEnv(SerialVecEnv):
+    def __init__(self, make_env, num_envs, dims, info_keys, recoverable_errors=(), num_workers=None):
+        """Steps the environments in a pool of subprocesses. Actions, observations, goals and
+        infos are exchanged through shared memory, only commands go through the pipes.
+
+        Args:
+            num_workers (int): the number of subprocesses, each owning a contiguous chunk of
+                environments; defaults to one subprocess per environment
+
+        See SerialVecEnv for the other arguments.
+        """
+        self.num_envs = num_envs
+        self.info_keys = info_keys
+        self.recoverable_errors = tuple(recoverable_errors)
+        shapes = buffer_shapes(num_envs, dims, info_keys)
+        shapes['u'] = (num_envs, dims['u'])
+        shapes['active'] = (num_envs,)
+        raw_buffers = {key: (RawArray('f', int(np.prod(shape))), shape) for key, shape in shapes.items()}
+        self.buffers = {key: shared_array(raw, shape) for key, (raw, shape) in raw_buffers.items()}
+
+        num_workers = min(num_workers or num_envs, num_envs)
+        self.env_ids = [ids.tolist() for ids in np.array_split(np.arange(num_envs), num_workers)]
+        self.worker_of_env = {i: w for w, ids in enumerate(self.env_ids) for i in ids}
+        self.remotes, self.work_remotes = zip(*[Pipe() for _ in range(num_workers)])
+        self.ps = [Process(target=worker, args=(work_remote, remote, CloudpickleWrapper(make_env),
+                                                raw_buffers, info_keys, env_ids, self.recoverable_errors))
+                   for (work_remote, remote, env_ids) in zip(self.work_remotes, self.remotes, self.env_ids)]
+        for p in self.ps:
+            p.daemon = True  # if the main process crashes, we should not cause things to hang
+            p.start()
+        for remote in self.work_remotes:
+            remote.close()
+        self.closed = False
+
+    def _call(self, remotes, cmd, data=None):
+        for remote in remotes:
+            remote.send((cmd, data))
+        errors = [e for e in [remote.recv() for remote in remotes] if e is not None]
+        if errors:
+            raise errors[0]
+
+    def reset(self, i):
+        self._call([self.remotes[self.worker_of_env[i]]], 'reset', i)
+        return self.buffers['o'][i], self.buffers['ag'][i], self.buffers['dg'][i]
+
+    def step(self, u, active=None):
+        self.buffers['u'][...] = u
+        if active is None:
+            self.buffers['active'][...] = 1.
+            remotes = self.remotes
+        else:
+            self.buffers['active'][...] = active
+            # workers whose environments are all inactive are not woken up
+            remotes = [remote for remote, env_ids in zip(self.remotes, self.env_ids) if active[env_ids].any()]
+        self._call(remotes, 'step')
+        return self._results()
+
+    def render(self):
+        self._call(self.remotes, 'render')
+
+    def seed(self, seed):
+        self._call(self.remotes, 'seed', seed)
+
+    def close(self):
+        if self.closed:
+            return
+        for remote in self.remotes:
+            remote.send(('close', None))
+        for p in self.ps:
+            p.join()
+        self.closed = True
+
+
+VEC_ENVS = {
+    'serial': SerialVecEnv,
+    'subproc': SubprocVecEnv,
+}
+
+
+def make_vec_env(vec_env, make_env, num_envs, dims, info_keys, **kwargs):
+    """Creates the vec env backend named `vec_env`, one of VEC_ENVS."""
+    return VEC_ENVS[vec_env](make_env, num_envs, dims, info_keys, **kwargs)
@@ -1,4 +1,6 @@
 import os
+import pickle
+import random
 import sys
 
 import click
@@ -11,6 +13,9 @@ from baselines.common import set_global_seeds
 from baselines.common.mpi_moments import mpi_moments
 import dher.ddpg_dher.dher_config as config
 import dher.ddpg_dher.dher_rollout as rollout
+import dher.ddpg_dher.dher_async as dher_async
+from dher.ddpg_dher.dher_timer import TIMERS, timer
+from dher.ddpg_dher.dher_policy import export_policy
 from baselines.her.util import mpi_fork
 
 from subprocess import CalledProcessError
@@ -33,31 +38,79 @@ def mpi_average(value):
     return mpi_moments(np.array(value))[0]
 
 
+def save_checkpoint(path, policy, rollout_worker, evaluator, epoch, best_success_rate):
+    """Saves the policy together with its optimizer, normalizer and replay buffer state and the
+    training progress, so that training can be resumed after `epoch`.
+    """
+    policy.save_checkpoint(path)
+    state = {
+        'epoch': epoch,
+        'best_success_rate': best_success_rate,
+        'np_random_state': np.random.get_state(),
+        'random_state': random.getstate(),
+        'n_episodes': (rollout_worker.n_episodes, evaluator.n_episodes),
+    }
+    with open(os.path.join(path, 'state.pkl.tmp'), 'wb') as f:
+        pickle.dump(state, f)
+    os.replace(os.path.join(path, 'state.pkl.tmp'), os.path.join(path, 'state.pkl'))
+
+
+def load_checkpoint(path, policy, rollout_worker, evaluator):
+    """Restores a checkpoint written by save_checkpoint and returns its training progress.
+    """
+    with open(os.path.join(path, 'state.pkl'), 'rb') as f:
+        state = pickle.load(f)
+    policy.load_checkpoint(path)
+    np.random.set_state(state['np_random_state'])
+    random.setstate(state['random_state'])
+    rollout_worker.n_episodes, evaluator.n_episodes = state['n_episodes']
+    return state
+
+
 def train(policy, rollout_worker, evaluator,
           n_epochs, n_test_rollouts, n_cycles, n_batches, policy_save_interval,
-          save_policies, **kwargs):
+          save_policies, async_worker=None, start_epoch=0, best_success_rate=-1,
+          checkpoint_path=None, checkpoint_interval=1, **kwargs):
     rank = MPI.COMM_WORLD.Get_rank()
 
     latest_policy_path = os.path.join(logger.get_dir(), 'policy_latest.pkl')
     best_policy_path = os.path.join(logger.get_dir(), 'policy_best.pkl')
     periodic_policy_path = os.path.join(logger.get_dir(), 'policy_{}.pkl')
+    # TensorFlow-free exports of the best and latest actor, see dher_policy.load_policy
+    latest_export_path = os.path.join(logger.get_dir(), 'policy_latest.npz')
+    best_export_path = os.path.join(logger.get_dir(), 'policy_best.npz')
+
+    # the fused train step performs several updates per call
+    updates_per_train = policy.fused_steps if policy.fused_train else 1
+    assert n_batches % updates_per_train == 0, 'fused_steps has to divide n_batches'
 
     logger.info("Training...")
-    best_success_rate = -1
-    for epoch in range(n_epochs):
+    if async_worker is not None:
+        async_worker.start()
+    for epoch in range(start_epoch, n_epochs):
         # train
         rollout_worker.clear_history()
         for _ in range(n_cycles):
-            episode = rollout_worker.generate_rollouts()
+            with timer('rollout'):
+                if async_worker is not None:
+                    # rollouts keep running in the background while the learner trains
+                    episode = async_worker.get_episode()
+                else:
+                    episode = rollout_worker.generate_rollouts()
             policy.store_episode(episode)
-            for _ in range(n_batches):
-                policy.train()
-            policy.update_target_net()
+            with timer('train'):
+                n_train = n_batches // updates_per_train
+                for i in range(n_train):
+                    # the last update of a cycle also moves the target network
+                    policy.train(update_target_net=(i == n_train - 1))
+            if async_worker is not None:
+                async_worker.record_updates(n_batches)
 
         # test
         evaluator.clear_history()
-        for _ in range(n_test_rollouts):
-            evaluator.generate_rollouts()
+        with timer('test'):
+            for _ in range(n_test_rollouts):
+                evaluator.generate_rollouts()
 
         # record logs
         logger.record_tabular('epoch', epoch)
@@ -67,6 +120,12 @@ def train(policy, rollout_worker, evaluator,
             logger.record_tabular(key, mpi_average(val))
         for key, val in policy.logs():
             logger.record_tabular(key, mpi_average(val))
+        if async_worker is not None:
+            for key, val in async_worker.logs():
+                logger.record_tabular(key, mpi_average(val))
+        for key, val in TIMERS.logs():
+            logger.record_tabular(key, mpi_average(val))
+        TIMERS.clear()
 
         if rank == 0:
             logger.dump_tabular()
@@ -78,6 +137,8 @@ def train(policy, rollout_worker, evaluator,
             logger.info('New best success rate: {}. Saving policy to {} ...'.format(best_success_rate, best_policy_path))
             evaluator.save_policy(best_policy_path)
             evaluator.save_policy(latest_policy_path)
+            export_policy(policy, best_export_path)
+            export_policy(policy, latest_export_path)
         if rank == 0 and policy_save_interval > 0 and epoch % policy_save_interval == 0 and save_policies:
             policy_path = periodic_policy_path.format(epoch)
             logger.info('Saving periodic policy to {} ...'.format(policy_path))
@@ -90,10 +151,19 @@ def train(policy, rollout_worker, evaluator,
         if rank != 0:
             assert local_uniform[0] != root_uniform[0]
 
+        if checkpoint_path is not None and checkpoint_interval > 0 and (epoch + 1) % checkpoint_interval == 0:
+            logger.info('Saving checkpoint to {} ...'.format(checkpoint_path))
+            with timer('checkpoint'):
+                save_checkpoint(checkpoint_path, policy, rollout_worker, evaluator, epoch, best_success_rate)
+
+    if async_worker is not None:
+        async_worker.stop()
+    policy.stop_prefetch()
+
 
 def launch(
     env, logdir, n_epochs, num_cpu, seed, replay_strategy, policy_save_interval, clip_return,
-    override_params={}, save_policies=True
+    override_params={}, save_policies=True, resume=False, checkpoint_interval=1
 ):
     # Fork for multi-CPU MPI implementation.
     if num_cpu > 1:
@@ -132,7 +202,8 @@ def launch(
     params.update(**override_params)  # makes it possible to override any parameter
     with open(os.path.join(logger.get_dir(), 'params.json'), 'w') as f:
         json.dump(params, f)
-    params = config.prepare_params(params)
+    params = config.prepare_params(params, cache_dir=logdir)
+    TIMERS.enabled = params['timing']
     config.log_params(params, logger=logger)
 
     if num_cpu == 1:
@@ -166,9 +237,17 @@ def launch(
         'T': params['T'],
     }
 
-    for name in ['T', 'rollout_batch_size', 'gamma', 'noise_eps', 'random_eps']:
+    for name in ['T', 'rollout_batch_size', 'gamma', 'noise_eps', 'random_eps', 'vec_env']:
         rollout_params[name] = params[name]
         eval_params[name] = params[name]
+    rollout_params['max_retries'] = params['rollout_max_retries']
+    eval_params['max_retries'] = params['rollout_max_retries']
+    eval_params['freeze_done'] = params['test_freeze_done']
+    n_test_rollouts = params['n_test_rollouts']
+    if params['test_batched']:
+        # one wide batch instead of n_test_rollouts consecutive ones
+        eval_params['rollout_batch_size'] *= n_test_rollouts
+        n_test_rollouts = 1
 
     rollout_worker = rollout.RolloutWorker(params['make_env'], policy, dims, logger, **rollout_params)
     rollout_worker.seed(rank_seed)
@@ -176,11 +255,40 @@ def launch(
     evaluator = rollout.RolloutWorker(params['make_env'], policy, dims, logger, **eval_params)
     evaluator.seed(rank_seed)
 
+    # every MPI worker checkpoints its own replay buffer into the logdir of rank 0; the other
+    # ranks log to a new temporary directory on every launch
+    checkpoint_root = MPI.COMM_WORLD.bcast(logdir if rank == 0 else None, root=0)
+    checkpoint_path = os.path.join(checkpoint_root, 'checkpoint', 'rank_{}'.format(rank))
+    start_epoch, best_success_rate = 0, -1
+    found = MPI.COMM_WORLD.allgather(os.path.exists(os.path.join(checkpoint_path, 'state.pkl')))
+    if resume and any(found):
+        # all ranks have to run the same epochs for the MPI collectives to line up
+        if not all(found):
+            raise RuntimeError('Cannot resume, ranks {} have no checkpoint in {}.'.format(
+                [i for i, has in enumerate(found) if not has], checkpoint_root))
+        state = load_checkpoint(checkpoint_path, policy, rollout_worker, evaluator)
+        epochs = MPI.COMM_WORLD.allgather(state['epoch'])
+        if len(set(epochs)) > 1:
+            raise RuntimeError('Cannot resume, the checkpoints of the ranks are from epochs {}.'.format(epochs))
+        start_epoch, best_success_rate = state['epoch'] + 1, state['best_success_rate']
+        logger.info('Resuming from epoch {} ...'.format(start_epoch))
+        # the environments are reseeded rather than restored
+        rollout_worker.seed(rank_seed + start_epoch)
+        evaluator.seed(rank_seed + start_epoch)
+
+    async_worker = None
+    if params['async_rollouts']:
+        async_worker = dher_async.AsyncRolloutWorker(
+            rollout_worker, policy, snapshot_interval=params['snapshot_interval'],
+            queue_size=params['async_queue_size'])
+
     train(
         logdir=logdir, policy=policy, rollout_worker=rollout_worker,
-        evaluator=evaluator, n_epochs=n_epochs, n_test_rollouts=params['n_test_rollouts'],
+        evaluator=evaluator, n_epochs=n_epochs, n_test_rollouts=n_test_rollouts,
         n_cycles=params['n_cycles'], n_batches=params['n_batches'],
-        policy_save_interval=policy_save_interval, save_policies=save_policies)
+        policy_save_interval=policy_save_interval, save_policies=save_policies,
+        async_worker=async_worker, start_epoch=start_epoch, best_success_rate=best_success_rate,
+        checkpoint_path=checkpoint_path, checkpoint_interval=checkpoint_interval)
 
 
 @click.command()
@@ -192,6 +300,8 @@ def launch(
 @click.option('--policy_save_interval', type=int, default=5, help='the interval with which policy pickles are saved. If set to 0, only the best and latest policy will be pickled.')
 @click.option('--replay_strategy', type=click.Choice(['future', 'none']), default='future', help='the HER replay strategy to be used. "future" uses HER, "none" disables HER.')
 @click.option('--clip_return', type=int, default=1, help='whether or not returns should be clipped')
+@click.option('--resume', is_flag=True, help='continue training from the last checkpoint in logdir, if there is one')
+@click.option('--checkpoint_interval', type=int, default=1, help='the interval in epochs with which full training checkpoints are saved to logdir. If set to 0, no checkpoints are saved.')
 def main(**kwargs):
     launch(**kwargs)
 
@@ -105,6 +105,7 @@ def learn(env,
           prioritized_replay_eps=1e-6,
           param_noise=False,
           log_path = None,
+          columnar_buffer=True,
           callback=None):
     """Train a deepq model.
 
@@ -161,6 +162,9 @@ def learn(env,
         to 1.0. If set to None equals to max_timesteps.
     prioritized_replay_eps: float
         epsilon to add to the TD errors when updating priorities.
+    columnar_buffer: bool
+        if True the replay buffer preallocates typed arrays from the observation
+        and action spaces instead of storing a python tuple per transition.
     callback: (locals, globals) -> None
         function called at every steps with state of the algorithm.
         If callback returns true training stops.
@@ -202,14 +206,22 @@ def learn(env,
 
     # Create the replay buffer
     if prioritized_replay:
-        replay_buffer = PrioritizedReplayBuffer(buffer_size, alpha=prioritized_replay_alpha)
+        if columnar_buffer:
+            replay_buffer = PrioritizedReplayBuffer(buffer_size, alpha=prioritized_replay_alpha,
+                                                    observation_space=env.observation_space,
+                                                    action_space=env.action_space)
+        else:
+            replay_buffer = PrioritizedReplayBuffer(buffer_size, alpha=prioritized_replay_alpha)
         if prioritized_replay_beta_iters is None:
             prioritized_replay_beta_iters = max_timesteps
         beta_schedule = LinearSchedule(prioritized_replay_beta_iters,
                                        initial_p=prioritized_replay_beta0,
                                        final_p=1.0)
     else:
-        replay_buffer = ReplayBuffer(buffer_size)
+        if columnar_buffer:
+            replay_buffer = ReplayBuffer(buffer_size, env.observation_space, env.action_space)
+        else:
+            replay_buffer = ReplayBuffer(buffer_size)
         beta_schedule = None
     # Create the schedule for exploration starting from 1.
     exploration = LinearSchedule(schedule_timesteps=int(exploration_fraction * max_timesteps),
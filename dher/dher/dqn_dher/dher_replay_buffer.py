@@ -6,8 +6,136 @@ from baselines.common.segment_tree import SumSegmentTree, MinSegmentTree
 from dher.dqn_dher.dher_sample import make_sample_her_experience
 
 
+class IntersectionIndex(object):
+    def __init__(self):
+        """Incrementally maintained index of the goals shared by achieved and desired positions.
+
+        The first four digits of an observation are the achieved goal (x, y) and the desired
+        goal (x, y). Each goal maps to the most recent buffer index it was seen at, and goals
+        that appear both as achieved and as desired goals are kept in a list so that they can
+        be sampled in O(1).
+        """
+        self._achieved = {}
+        self._desired = {}
+        self._keys = []
+        self._key_pos = {}
+
+    def __len__(self):
+        return len(self._keys)
+
+    def _link(self, key):
+        if key not in self._key_pos:
+            self._key_pos[key] = len(self._keys)
+            self._keys.append(key)
+
+    def _unlink(self, key):
+        pos = self._key_pos.pop(key, None)
+        if pos is None:
+            return
+        last = self._keys.pop()
+        if pos < len(self._keys):
+            self._keys[pos] = last
+            self._key_pos[last] = pos
+
+    def add(self, obs, idx):
+        """Registers the goals of observation `obs` stored at buffer index `idx`."""
+        ac_key = (obs[0], obs[1])
+        de_key = (obs[2], obs[3])
+        self._achieved[ac_key] = idx
+        self._desired[de_key] = idx
+        if ac_key in self._desired:
+            self._link(ac_key)
+        if de_key in self._achieved:
+            self._link(de_key)
+
+    def remove(self, obs, idx):
+        """Drops the goals of observation `obs` if buffer index `idx` is still their latest
+        occurrence, i.e. before the slot is overwritten.
+        """
+        ac_key = (obs[0], obs[1])
+        de_key = (obs[2], obs[3])
+        if self._achieved.get(ac_key) == idx:
+            del self._achieved[ac_key]
+            self._unlink(ac_key)
+        if self._desired.get(de_key) == idx:
+            del self._desired[de_key]
+            self._unlink(de_key)
+
+    def sample(self, batch_size):
+        """Returns `batch_size` random (achieved_idx, desired_idx) pairs of buffer indices
+        whose achieved goal and desired goal coincide.
+        """
+        pairs = []
+        for _ in range(batch_size):
+            key = self._keys[random.randint(0, len(self._keys) - 1)]
+            pairs.append((self._achieved[key], self._desired[key]))
+        return pairs
+
+
+class ArrayStorage(object):
+    def __init__(self, size, observation_space, action_space):
+        """Columnar storage for transitions backed by preallocated NumPy arrays.
+
+        Behaves like the list of (obs_t, action, reward, obs_tp1, done) tuples used by
+        ReplayBuffer, but writes in place and gathers batches with fancy indexing.
+
+        Parameters
+        ----------
+        size: int
+            Max number of transitions to store.
+        observation_space: gym.spaces.Box
+            space the shape and dtype of the observations are taken from
+        action_space: gym.Space
+            space the shape and dtype of the actions are taken from
+        """
+        self._obses_t = np.zeros((size,) + observation_space.shape, dtype=observation_space.dtype)
+        self._actions = np.zeros((size,) + action_space.shape, dtype=action_space.dtype)
+        self._rewards = np.zeros(size, dtype=np.float32)
+        self._obses_tp1 = np.zeros((size,) + observation_space.shape, dtype=observation_space.dtype)
+        self._dones = np.zeros(size, dtype=np.float32)
+        self._len = 0
+
+    def __len__(self):
+        return self._len
+
+    def _wrap(self, idxes):
+        # negative indices count from the last stored transition like on a list, not from the
+        # end of the preallocated arrays, whose tail is unwritten until the buffer is full
+        idxes = np.asarray(idxes)
+        return np.where(idxes < 0, idxes + self._len, idxes)
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += self._len
+        return (self._obses_t[idx], self._actions[idx], self._rewards[idx],
+                self._obses_tp1[idx], self._dones[idx])
+
+    def __setitem__(self, idx, data):
+        obs_t, action, reward, obs_tp1, done = data
+        self._obses_t[idx] = obs_t
+        self._actions[idx] = action
+        self._rewards[idx] = reward
+        self._obses_tp1[idx] = obs_tp1
+        self._dones[idx] = done
+
+    def append(self, data):
+        self[self._len] = data
+        self._len += 1
+
+    def take(self, idxes):
+        """Gathers the transitions at `idxes` as a tuple of arrays."""
+        idxes = self._wrap(idxes)
+        return (self._obses_t[idxes], self._actions[idxes], self._rewards[idxes],
+                self._obses_tp1[idxes], self._dones[idxes])
+
+    def take_column(self, column, idxes):
+        """Gathers field `column` (0: obs_t, ..., 4: done) of the transitions at `idxes`."""
+        idxes = self._wrap(idxes)
+        return (self._obses_t, self._actions, self._rewards, self._obses_tp1, self._dones)[column][idxes]
+
+
 class ReplayBuffer(object):
-    def __init__(self, size):
+    def __init__(self, size, observation_space=None, action_space=None):
         """Create Replay buffer.
 
         Parameters
@@ -15,10 +143,19 @@ class ReplayBuffer(object):
         size: int
             Max number of transitions to store in the buffer. When the buffer
             overflows the old memories are dropped.
+        observation_space: gym.spaces.Box
+            if given together with `action_space`, transitions are stored in
+            preallocated typed arrays (see ArrayStorage) instead of python tuples
+        action_space: gym.Space
+            action space of the environment, see `observation_space`
         """
-        self._storage = []
+        if observation_space is not None and action_space is not None:
+            self._storage = ArrayStorage(size, observation_space, action_space)
+        else:
+            self._storage = []
         self._maxsize = size
         self._next_idx = 0
+        self._intersection = IntersectionIndex()
 
     def __len__(self):
         return len(self._storage)
@@ -29,34 +166,35 @@ class ReplayBuffer(object):
         if self._next_idx >= len(self._storage):
             self._storage.append(data)
         else:
+            self._intersection.remove(self._storage[self._next_idx][0], self._next_idx)
             self._storage[self._next_idx] = data
+        # index the stored observation, which ArrayStorage has cast to the observation dtype, so
+        # that remove finds the same keys when the slot is overwritten
+        self._intersection.add(self._storage[self._next_idx][0], self._next_idx)
         self._next_idx = (self._next_idx + 1) % self._maxsize
 
     def _encode_sample(self, idxes):
-        obses_t, actions, rewards, obses_tp1, dones = [], [], [], [], []
-        for i in idxes:
-            data = self._storage[i]
-            obs_t, action, reward, obs_tp1, done = data
-            obses_t.append(np.array(obs_t, copy=False))
-            actions.append(np.array(action, copy=False))
-            rewards.append(reward)
-            obses_tp1.append(np.array(obs_tp1, copy=False))
-            dones.append(done)
-
-        # DHER
-        batch_size = len(idxes)
-        sample_batch = make_sample_her_experience(self._storage, batch_size)
-        for i in range(batch_size):
-            exp = sample_batch[i]
-            for j in range(len(exp)):
-                obs_t, action, reward, obs_tp1, done = exp[j]
+        if isinstance(self._storage, ArrayStorage):
+            batch = self._storage.take(idxes)
+        else:
+            obses_t, actions, rewards, obses_tp1, dones = [], [], [], [], []
+            for i in idxes:
+                data = self._storage[i]
+                obs_t, action, reward, obs_tp1, done = data
                 obses_t.append(np.array(obs_t, copy=False))
                 actions.append(np.array(action, copy=False))
                 rewards.append(reward)
                 obses_tp1.append(np.array(obs_tp1, copy=False))
                 dones.append(done)
+            batch = (np.array(obses_t), np.array(actions), np.array(rewards),
+                     np.array(obses_tp1), np.array(dones))
 
-        return np.array(obses_t), np.array(actions), np.array(rewards), np.array(obses_tp1), np.array(dones)
+        # DHER
+        her_batch = make_sample_her_experience(self._storage, len(idxes), self._intersection)
+        if her_batch is None:
+            return batch
+        return tuple(np.concatenate([col, her_col.astype(col.dtype, copy=False)])
+                     for col, her_col in zip(batch, her_batch))
 
     def sample(self, batch_size):
         """Sample a batch of experiences.
@@ -85,7 +223,7 @@ class ReplayBuffer(object):
 
 
 class PrioritizedReplayBuffer(ReplayBuffer):
-    def __init__(self, size, alpha):
+    def __init__(self, size, alpha, observation_space=None, action_space=None):
         """Create Prioritized Replay buffer.
 
         Parameters
@@ -96,12 +234,16 @@ class PrioritizedReplayBuffer(ReplayBuffer):
         alpha: float
             how much prioritization is used
             (0 - no prioritization, 1 - full prioritization)
+        observation_space: gym.spaces.Box
+            see ReplayBuffer.__init__
+        action_space: gym.Space
+            see ReplayBuffer.__init__
 
         See Also
         --------
         ReplayBuffer.__init__
         """
-        super(PrioritizedReplayBuffer, self).__init__(size)
+        super(PrioritizedReplayBuffer, self).__init__(size, observation_space, action_space)
         assert alpha >= 0
         self._alpha = alpha
 
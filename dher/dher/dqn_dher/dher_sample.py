@@ -1,80 +1,56 @@
 import numpy as np
-import random
 
 
-def make_sample_her_experience(episode_batch, batch_size):
-    """Creates a sample function that can be used for HER experience replay.
+def _take_column(data, column, idxes):
+    """Gathers field `column` of the transitions at `idxes` from either a list of
+    transition tuples or an ArrayStorage.
     """
+    if hasattr(data, 'take_column'):
+        return data.take_column(column, idxes)
+    flat = [data[i][column] for i in idxes.ravel()]
+    return np.array(flat).reshape(idxes.shape + np.shape(flat[0]))
 
-    def hash_memory(data):
-        achieved_hash = {}
-        desired_hash = {}
-        for idx in range(len(data)):
-            ac_x = data[idx][0][0]
-            ac_y = data[idx][0][1]
-            de_x = data[idx][0][2]
-            de_y = data[idx][0][3]
-            achieved_hash[(ac_x, ac_y)] = idx
-            desired_hash[(de_x, de_y)] = idx
-        return achieved_hash, desired_hash
 
-    def search_memory(data):
-        intersection_set = []
-        achieved_hash, desired_hash = hash_memory(data)
-        for key, val in achieved_hash.items():
-            temp_x, temp_y = key
-            ac_idx = val
-            if (temp_x, temp_y) in desired_hash:
-                sel = desired_hash[(temp_x, temp_y)]
-                de_idx = sel
-                intersection_set.append((ac_idx, de_idx))
-        return intersection_set
+def make_sample_her_experience(episode_batch, batch_size, intersection, future_t=8):
+    """Creates a sample function that can be used for HER experience replay.
 
-    intersection = search_memory(episode_batch)
+    `intersection` is the IntersectionIndex kept up to date by the replay buffer, so that
+    the cost of sampling does not depend on the size of the buffer. All synthesized
+    transitions of the batch are built at once and returned as a tuple of arrays
+    (obs, action, reward, obs_tp1, done), or None if there is nothing to replay.
+    """
     if len(intersection) == 0:
-        return []
+        return None
 
-    future_t = 8
-    sample_batch = []
     data = episode_batch
-    for i in range(batch_size):
-        rand_i = random.randint(0, len(intersection) - 1)
-        ac_idx, de_idx = intersection[rand_i]
-        future_t = 8
-        new_ft = 0
-        for j in range(future_t):
-            ac_done = data[ac_idx - j][4]
-            de_done = data[de_idx - j][4]
-            if ac_done == 1 or de_done == 1:
-                break
-            new_ft += 1
-        new_ft = new_ft - 2
-        de_idx = de_idx - new_ft
-        ac_idx = ac_idx - new_ft
-        new_exp = []
-        for j in range(new_ft):
-            ac_x = data[ac_idx][0][0]
-            ac_y = data[ac_idx][0][1]
-            de_x = data[de_idx][0][2]
-            de_y = data[de_idx][0][3]
-            ac_x2 = data[ac_idx + 1][0][0]
-            ac_y2 = data[ac_idx + 1][0][1]
-            de_x2 = data[de_idx + 1][0][2]
-            de_y2 = data[de_idx + 1][0][3]
-            ne_obs = [ac_x, ac_y, de_x, de_y, ac_x - de_x, ac_y - de_y]
-            ne_act = data[ac_idx][1]
-            ne_reward = -1.0
-            ne_done = 0
-            if j == new_ft - 1:
-                ne_reward = 0.0
-                ne_done = 1
-            ne_obs2 = [
-                ac_x2, ac_y2, de_x2, de_y2, ac_x2 - de_x2, ac_y2 - de_y2
-            ]
-            new_exp.append((np.asarray(ne_obs), ne_act, ne_reward,
-                            np.asarray(ne_obs2), ne_done))
-            ac_idx += 1
-            de_idx += 1
-        sample_batch.append(new_exp)
+    pairs = np.array(intersection.sample(batch_size))
+    ac_idx, de_idx = pairs[:, 0], pairs[:, 1]
+
+    # walk back at most future_t steps from both indices until an episode boundary
+    offsets = np.arange(future_t)
+    ac_done = _take_column(data, 4, ac_idx[:, None] - offsets)
+    de_done = _take_column(data, 4, de_idx[:, None] - offsets)
+    boundary = (ac_done == 1) | (de_done == 1)
+    new_ft = np.where(boundary.any(axis=1), boundary.argmax(axis=1), future_t) - 2
+    new_ft = np.maximum(new_ft, 0)
+    if new_ft.sum() == 0:
+        return None
+
+    # one row per synthesized transition, j counts the steps within each sample
+    sample_idx = np.repeat(np.arange(batch_size), new_ft)
+    j = np.arange(len(sample_idx)) - np.repeat(np.cumsum(new_ft) - new_ft, new_ft)
+    ac_idx = ac_idx[sample_idx] - new_ft[sample_idx] + j
+    de_idx = de_idx[sample_idx] - new_ft[sample_idx] + j
+
+    def splice(ac, de):
+        ac_pos = _take_column(data, 0, ac)[:, 0:2]
+        de_pos = _take_column(data, 0, de)[:, 2:4]
+        return np.concatenate([ac_pos, de_pos, ac_pos - de_pos], axis=1)
 
-    return sample_batch
\ No newline at end of file
+    last = j == new_ft[sample_idx] - 1
+    ne_obs = splice(ac_idx, de_idx)
+    ne_act = _take_column(data, 1, ac_idx)
+    ne_reward = np.where(last, 0.0, -1.0)
+    ne_obs2 = splice(ac_idx + 1, de_idx + 1)
+    ne_done = last.astype(np.int64)
+    return ne_obs, ne_act, ne_reward, ne_obs2, ne_done
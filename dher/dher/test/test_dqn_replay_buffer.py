@@ -0,0 +1,21 @@
+import numpy as np
+from gym import spaces
+
+from dher.dqn_dher.dher_replay_buffer import ReplayBuffer
+
+
+def test_overwritten_goals_leave_the_intersection_index():
+    size = 4
+    buffer = ReplayBuffer(size, spaces.Box(low=-1., high=1., shape=(6,), dtype=np.float32), spaces.Discrete(5))
+    # float64 goals that change when cast to float32; the achieved and desired goals of the
+    # first transitions intersect
+    goal = np.array([0.1, 0.2])
+    for _ in range(size):
+        buffer.add(np.concatenate([goal, goal, goal - goal]), 0, -1., np.zeros(6), 0.)
+    assert len(buffer._intersection) == 1
+
+    # overwrite every slot with goals that do not intersect
+    for i in range(size):
+        obs = np.array([0.3, 0.4 + 0.01 * i, -0.3, -0.4, 0., 0.])
+        buffer.add(obs, 0, -1., np.zeros(6), 0.)
+    assert len(buffer._intersection) == 0
@@ -218,4 +218,119 @@ class SnakeEnv(Env):
             # print(action)
             print(obs, reward)
             if self.done:
-                break
\ No newline at end of file
+                break
+
+# (dx, dy) of the actions None, Up, Down, Left, Right
+MOVES = np.array([[0, 0], [0, -1], [0, 1], [-1, 0], [1, 0]])
+
+
+class BatchSnakeEnv(object):
+    def __init__(self,
+                 num_envs,
+                 state_size=20,
+                 reward_type='sparse',
+                 reward_dir='random',
+                 middle_reset=False,
+                 diff=1):
+        """
+        Steps `num_envs` independent SnakeEnv games at once. The positions of the snakes and
+        goals are kept in int arrays and moved with array operations, and the stacked
+        observations are written into a preallocated (num_envs, 6) buffer that is returned by
+        reset and step, and overwritten by the next call.
+
+        The arguments are those of SnakeEnv. Rendering is not supported.
+        """
+        self.num_envs = num_envs
+        self.state_size = state_size
+        self.reward_type = reward_type
+        self.reward_dir = reward_dir
+        self.middle_reset = middle_reset
+        self.diff = diff
+
+        self.action_space = spaces.Discrete(5)
+        self.observation_space = spaces.Box(
+            low=-state_size, high=state_size, shape=(6, ))
+
+        self.snake = np.zeros((num_envs, 2), dtype=np.int64)
+        self.goal = np.zeros((num_envs, 2), dtype=np.int64)
+        self.obs = np.zeros((num_envs, 6), dtype=np.int64)
+
+    def _write_obs(self, idxs):
+        self.obs[idxs, 0:2] = self.snake[idxs]
+        self.obs[idxs, 2:4] = self.goal[idxs]
+        self.obs[idxs, 4:6] = self.snake[idxs] - self.goal[idxs]
+
+    def reset(self, idxs=None):
+        """
+        Resets the games `idxs` (all by default) and returns the observations of all games.
+        """
+        if idxs is None:
+            idxs = np.arange(self.num_envs)
+        idxs = np.atleast_1d(idxs)
+        size = self.state_size
+        self.snake[idxs] = np.random.randint(size, size=(len(idxs), 2))
+
+        if not self.middle_reset:
+            # goals never spawn on the snake
+            redraw = idxs
+            while len(redraw) > 0:
+                self.goal[redraw] = np.random.randint(size, size=(len(redraw), 2))
+                redraw = redraw[(self.goal[redraw] == self.snake[redraw]).all(axis=1)]
+        else:
+            offsets = np.random.randint(-self.diff, self.diff + 1, size=(len(idxs), 2))
+            goal = np.clip(self.snake[idxs] + offsets, 0, size - 1)
+            # goals on the snake are moved one cell along x
+            on_snake = (goal == self.snake[idxs]).all(axis=1)
+            goal[on_snake, 0] += np.where(goal[on_snake, 0] < size - 1, 1, -1)
+            self.goal[idxs] = goal
+
+        self._write_obs(idxs)
+        return self.obs
+
+    def _goal_actions(self):
+        if isinstance(self.reward_dir, int):
+            return np.full(self.num_envs, self.reward_dir)
+        # random goal moves exclude the actions leading over the boundary of the board
+        x, y = self.goal[:, 0], self.goal[:, 1]
+        allowed = np.ones((self.num_envs, 5), dtype=bool)
+        allowed[:, 3] = x != 0
+        allowed[:, 4] = x != self.state_size - 1
+        allowed[:, 1] = y != 0
+        allowed[:, 2] = y != self.state_size - 1
+        # the k-th allowed action, k uniform over the number of allowed actions
+        k = (np.random.uniform(size=self.num_envs) * allowed.sum(axis=1)).astype(np.int64)
+        return np.argmax(np.cumsum(allowed, axis=1) > k[:, None], axis=1)
+
+    def step(self, actions):
+        """
+        actions (array of ints): one number from 0 to 4 per game, denoting None, Up, Down,
+            Left, Right respectively.
+
+        Returns:
+        observations (array): (num_envs, 6) observations, owned by the env
+        rewards (array): (num_envs,) rewards
+        dones (array): (num_envs,) whether the snakes reached their goals
+        info (dict): 'is_success' flags of the games
+        """
+        actions = np.asarray(actions)
+        assert ((actions >= 0) & (actions < 5)).all()
+
+        self.snake += MOVES[actions]
+        np.clip(self.snake, 0, self.state_size - 1, out=self.snake)
+
+        # goals that were not reached move on, wrapping around the board
+        moving = (self.snake != self.goal).any(axis=1)
+        self.goal[moving] += MOVES[self._goal_actions()[moving]]
+        self.goal %= self.state_size
+
+        self._write_obs(slice(None))
+        dones = (self.obs[:, 4:6] == 0).all(axis=1)
+        rewards = self.compute_reward(self.snake, self.goal, None)
+        return self.obs, rewards, dones, {'is_success': dones}
+
+    def compute_reward(self, achieved_goal, goal, info):
+        d = np.linalg.norm(achieved_goal - goal, ord=1, axis=-1)
+        if self.reward_type == 'sparse':
+            return -(d != 0.0).astype(np.float32)
+        else:
+            return -d